@@ -19,7 +19,7 @@ def main():
         app.exec_()
     else:
         hgbcli = HGBCLI(hgbcore)
-        hgbcli.parse_command_line(sys.argv)
+        sys.exit(hgbcli.parse_command_line(sys.argv))
 
 
 if __name__ == "__main__":
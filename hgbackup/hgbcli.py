@@ -1,3 +1,55 @@
+import re
+import sys
+import json
+import time
+import argparse
+import fnmatch
+import signal
+import contextlib
+
+from .hgbjobs import HGBJobs
+from .hgbsched import HGBScheduler
+
+# exit codes for scripted use (2 is also what argparse uses for invalid command lines)
+EXIT_OK = 0
+EXIT_FAILED = 1
+EXIT_USAGE = 2
+EXIT_UNAVAILABLE = 3
+EXIT_ERROR = 4
+EXIT_CANCELLED = 130  # 128 + SIGINT
+
+# interval in seconds at which the daemon checks whether the configuration file changed
+CONFIG_POLL_INTERVAL = 5
+
+ACTIONS = [
+    "check",
+    "repair",
+    "verify",
+    "sample",
+    "run",
+    "run-full",
+    "dryrun",
+    "dryrun-full",
+    "fanout",
+    "fanout-full",
+]
+
+
+# commands other than the actions: name -> (method, minimum and maximum number of arguments)
+COMMANDS = {
+    "list": ("list_command", 0, 1),
+    "daemon": ("daemon_command", 0, 1),
+    "history": ("history_command", 2, 2),
+    "diff": ("diff_command", 2, None),
+    "restore": ("restore_command", 3, 4),
+    "remove": ("remove_command", 1, 1),
+    "add": ("add_command", 3, 3),
+}
+
+# format of the timestamps of backups, e.g. to restore the versions before one
+TIMESTAMP = re.compile(r"\d{4}-\d{2}-\d{2}_\d{2}:\d{2}:\d{2}")
+
+
 class bcolors:
     HEADER = "\033[95m"
     OKBLUE = "\033[94m"
@@ -12,8 +64,27 @@ class bcolors:
 class HGBCLI:
     def __init__(self, hgbcore):
         self.hgbcore = hgbcore
+        self.fanout_reports = {}  # target name -> report of a fan-out backup in this batch
 
-    def list_targets(self):
+    def list_targets(self, fmt="text"):
+        if fmt != "text":
+            targets = [
+                {
+                    "target": name,
+                    "src": target["src"],
+                    "dst": target["dst"],
+                    "connected": target["dst_connected"],
+                    "last_backup": target["last_backup"],
+                    "last_check": target["last_check"],
+                }
+                for name, target in self.hgbcore.config["targets"].items()
+            ]
+            if fmt == "json":
+                print(json.dumps({"targets": targets}, indent=4))
+            else:
+                for t in targets:
+                    print(json.dumps(t))
+            return EXIT_OK
         print("List of targets:")
         for name, target in self.hgbcore.config["targets"].items():
             print(
@@ -23,11 +94,14 @@ class HGBCLI:
                     bcolors.ENDC,
                     target["src"],
                     target["dst"],
-                    bcolors.OKGREEN + "[ready]" + bcolors.ENDC
-                    if target["dst_connected"]
-                    else bcolors.FAIL + "[N/A]" + bcolors.ENDC,
+                    (
+                        bcolors.OKGREEN + "[ready]" + bcolors.ENDC
+                        if target["dst_connected"]
+                        else bcolors.FAIL + "[N/A]" + bcolors.ENDC
+                    ),
                 )
             )
+        return EXIT_OK
 
     def check_target(self, targetname):
         if targetname not in self.hgbcore.config["targets"]:
@@ -38,33 +112,347 @@ class HGBCLI:
             return self.hgbcore.config["targets"][targetname]
         return None
 
-    def parse_command_line(self, argv):
-        if len(argv) == 2 and argv[1] == "list":
-            self.list_targets()
-        elif len(argv) == 3 and argv[1] == "remove":
-            self.hgbcore.remove_target(argv[2])
-        elif len(argv) == 3:
-            target = self.check_target(argv[2])
-            if target is None:
-                return
-            if argv[1] == "check":
-                self.hgbcore.check_verdict(target)
-            elif argv[1] == "repair":
-                self.hgbcore.check_verdict(target, repair=True)
-            elif argv[1] == "verify":
-                self.hgbcore.verify_backup(target)
-            elif argv[1] == "run":
-                self.hgbcore.run_backup(target)
-            elif argv[1] == "run-full":
-                self.hgbcore.run_backup(target, full=True)
-            elif argv[1] == "dryrun":
-                self.hgbcore.run_backup(target, dry=True)
-            elif argv[1] == "dryrun-full":
-                self.hgbcore.run_backup(target, dry=True, full=True)
-        elif len(argv) == 5 and argv[1] == "add":
-            if argv[2] in self.hgbcore.config["targets"]:
-                print("Target {} is already defined.".format(argv[2]))
-            else:
-                self.hgbcore.add_target(argv[2], argv[3], argv[4])
+    def match_targets(self, patterns, all_targets=False):
+        # resolve target names and glob patterns (in configuration order, without duplicates)
+        names = list(self.hgbcore.config["targets"])
+        if all_targets:
+            return names, []
+        matched = []
+        unmatched = []
+        for pattern in patterns:
+            found = [n for n in names if fnmatch.fnmatchcase(n, pattern)]
+            if not found:
+                unmatched.append(pattern)
+            for n in found:
+                if n not in matched:
+                    matched.append(n)
+        return matched, unmatched
+
+    def run_action(self, action, target, options=None):
+        options = options or {}
+        if action == "check":
+            self.hgbcore.check_verdict(target)
+        elif action == "repair":
+            self.hgbcore.check_verdict(target, repair=True)
+        elif action == "verify":
+            self.hgbcore.verify_backup(
+                target,
+                max_errors=options.get("max_errors"),
+                max_error_rate=options.get("max_error_rate"),
+                resume=options.get("resume", False),
+            )
+        elif action == "sample":
+            self.hgbcore.sample_verify(
+                target,
+                sample_size=options.get("sample_size", 1000),
+                time_budget=options.get("time_budget"),
+                byte_budget=options.get("byte_budget"),
+                seed=options.get("seed"),
+            )
+        elif action == "run":
+            self.hgbcore.run_backup(target)
+        elif action == "run-full":
+            self.hgbcore.run_backup(target, full=True)
+        elif action == "dryrun":
+            self.hgbcore.run_backup(target, dry=True)
+        elif action == "dryrun-full":
+            self.hgbcore.run_backup(target, dry=True, full=True)
+        elif action in ["fanout", "fanout-full"]:
+            return self.run_fanout(target, options.get("selected", []), action == "fanout-full")
+        return target.get("report", {})
+
+    def run_fanout(self, target, selected, full):
+        # back up all selected targets with the same src at once, when the first one comes up
+        name = [n for n, t in self.hgbcore.config["targets"].items() if t is target][0]
+        if name not in self.fanout_reports:
+            names = [
+                n for n in selected if self.hgbcore.config["targets"][n]["src"] == target["src"]
+            ]
+            if name not in names:
+                names = [name]
+            self.hgbcore.run_fanout([self.hgbcore.config["targets"][n] for n in names], full=full)
+            for n in names:
+                self.fanout_reports[n] = self.hgbcore.config["targets"][n].get("report", {})
+        return self.fanout_reports[name]
+
+    def run_batch(self, actions, names, fmt="text", keep_going=False, out=None, options=None):
+        # run every action on every target within this process, so that the configuration is
+        # loaded and the disks are probed only once, and verification dictionaries are reused
+        out = out or sys.stdout
+        options = dict(options or {}, selected=names)
+        results = []
+        exit_code = EXIT_OK
+        for name in names:
+            for action in actions:
+                result, code = self.batch_result(action, name, options)
+                results.append(result)
+                exit_code = max(exit_code, code)
+                self.print_result(result, fmt, out)
+                if self.hgbcore.cancel_event.is_set():
+                    exit_code = EXIT_CANCELLED
+                    break
+                if not result["ok"] and not keep_going:
+                    break  # skip the remaining actions for this target
+            if self.hgbcore.cancel_event.is_set():
+                break
+        if fmt == "json":
+            out.write(json.dumps({"results": results, "exit_code": exit_code}, indent=4) + "\n")
+        return exit_code
+
+    def batch_result(self, action, name, options):
+        # run an action of a batch, returns its result and exit code
+        target = self.hgbcore.config["targets"][name]
+        result = {"target": name, "action": action}
+        t0 = time.time()
+        target["report"] = {}
+        if not target["dst_connected"]:
+            result.update({"ok": False, "error": "not connected", "counts": {}})
+            code = EXIT_UNAVAILABLE
         else:
-            print("Invalid command line.")
+            try:
+                report = dict(self.run_action(action, target, options))
+                result["ok"] = report.pop("ok", True)
+                report.pop("seconds", None)
+                result["counts"] = report
+                code = EXIT_OK if result["ok"] else EXIT_FAILED
+            except Exception as e:
+                result.update({"ok": False, "error": str(e), "counts": {}})
+                code = EXIT_ERROR
+        result["seconds"] = round(time.time() - t0, 3)
+        return result, code
+
+    def print_result(self, result, fmt, out):
+        # results are streamed with ndjson, collected with json, and only failures shown as text
+        if fmt == "ndjson":
+            out.write(json.dumps(result) + "\n")
+            out.flush()
+        elif fmt == "text" and not result["ok"]:
+            print(
+                "{}{} {}: {}{}".format(
+                    bcolors.FAIL,
+                    result["action"],
+                    result["target"],
+                    result.get("error", "failed"),
+                    bcolors.ENDC,
+                )
+            )
+
+    def parse_batch(self, argv):
+        parser = argparse.ArgumentParser(
+            prog="hgbackup",
+            description="Run one or several actions on one or several targets.",
+        )
+        parser.add_argument(
+            "actions",
+            help="comma-separated list of actions, executed in order ({})".format(
+                ", ".join(ACTIONS)
+            ),
+        )
+        parser.add_argument("targets", nargs="*", help="target names or glob patterns")
+        parser.add_argument("--all", action="store_true", help="select all targets")
+        parser.add_argument("--format", choices=["text", "json", "ndjson"], default="text")
+        parser.add_argument(
+            "--keep-going",
+            action="store_true",
+            help="run the remaining actions on a target even if one of them failed",
+        )
+        parser.add_argument(
+            "--max-errors",
+            type=int,
+            default=None,
+            help="verify: abort after this number of invalid or unreadable files",
+        )
+        parser.add_argument(
+            "--max-error-rate",
+            type=float,
+            default=None,
+            help="verify: abort when the fraction of invalid or unreadable files exceeds this",
+        )
+        parser.add_argument(
+            "--sample-size", type=int, default=1000, help="sample: number of files to hash"
+        )
+        parser.add_argument(
+            "--time-budget", type=float, default=None, help="sample: maximum duration in seconds"
+        )
+        parser.add_argument(
+            "--byte-budget", type=int, default=None, help="sample: maximum number of bytes to read"
+        )
+        parser.add_argument("--seed", type=int, default=None, help="sample: random seed")
+        parser.add_argument(
+            "--resume",
+            action="store_true",
+            help="verify: continue a cancelled verification from its checkpoint",
+        )
+        args = parser.parse_args(argv[1:])
+        actions = args.actions.split(",")
+        for action in actions:
+            if action not in ACTIONS:
+                parser.error("invalid action: {}".format(action))
+        if not args.targets and not args.all:
+            parser.error("no target given (use --all to select all targets)")
+        return args, actions
+
+    def print_history(self, target, pattern):
+        found = False
+        for path, history in self.hgbcore.change_history(target, pattern):
+            found = True
+            print("{}{}{}".format(bcolors.BOLD, path, bcolors.ENDC))
+            for timestamp in history:
+                print("    changed by backup {}".format(timestamp))
+        if not found:
+            print("No changes of {} recorded.".format(pattern))
+            return EXIT_FAILED
+        return EXIT_OK
+
+    def run_daemon(self, max_jobs=1):
+        # run due backups and verifications until interrupted
+        out = sys.stdout
+        jobs = HGBJobs()
+
+        def print_event(job, event, *args):
+            if event == "output":
+                out.write(args[0])
+            elif event in ["started", "finished"]:
+                out.write("\n[{}] {} job {}\n".format(job.name, job.fn.__name__, event))
+            out.flush()
+
+        jobs.subscribe(print_event)
+        scheduler = HGBScheduler(self.hgbcore, jobs, max_jobs=max_jobs)
+        scheduler.start()
+        self.hgbcore.start_tracker()
+        print("Scheduler running, press Ctrl+C to stop.")
+        try:
+            while True:
+                time.sleep(CONFIG_POLL_INTERVAL)
+                if self.hgbcore.reload_config():
+                    print("Configuration reloaded.")
+                    scheduler.reschedule()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            scheduler.stop()
+            jobs.shutdown()
+            self.hgbcore.stop_tracker()
+        return EXIT_CANCELLED
+
+    def interrupt(self, signum, frame):
+        # first Ctrl+C: cancel cleanly (e.g. saving the verification dictionary), second: abort
+        if self.hgbcore.cancel_event.is_set():
+            raise KeyboardInterrupt
+        print("\nCancelling (press Ctrl+C again to abort immediately)...", file=sys.stderr)
+        self.hgbcore.cancel_event.set()
+
+    def usage(self):
+        print("Invalid command line.")
+        return EXIT_USAGE
+
+    def list_command(self, args):
+        if args and args != ["--json"] and args != ["--ndjson"]:
+            return self.usage()
+        return self.list_targets(args[0][2:] if args else "text")
+
+    def daemon_command(self, args):
+        if args and not args[0].isdigit():
+            return self.usage()
+        return self.run_daemon(int(args[0]) if args else 1)
+
+    def history_command(self, args):
+        # when did paths (relative to dst, glob patterns allowed) change in the backup
+        target = self.check_target(args[0])
+        if target is None:
+            return EXIT_UNAVAILABLE
+        return self.print_history(target, args[1])
+
+    def diff_command(self, args):
+        # compare backups of the same src on different dst by their verification dictionaries
+        targets = [self.check_target(name) for name in args if name != "--sync"]
+        if None in targets:
+            return EXIT_UNAVAILABLE
+        if len(targets) < 2:
+            return self.usage()
+        report = self.hgbcore.compare_targets(targets, sync="--sync" in args)
+        if report["ok"]:
+            print("The verification dictionaries are identical.")
+        return EXIT_OK if report["ok"] else EXIT_FAILED
+
+    def restore_command(self, args):
+        # restore files (or their versions before a timestamp) to another folder
+        before = args[3] if len(args) == 4 else None
+        if before is not None and not TIMESTAMP.fullmatch(before):
+            print("Invalid timestamp {}, expected YYYY-MM-DD_HH:MM:SS.".format(before))
+            return EXIT_USAGE
+        target = self.check_target(args[0])
+        if target is None:
+            return EXIT_UNAVAILABLE
+        signal.signal(signal.SIGINT, self.interrupt)
+        report = self.hgbcore.restore(target, args[1], args[2], before=before)
+        print(
+            "Restored {} files ({} verified), {} invalid, {} errors.".format(
+                report["restored"], report["verified"], report["invalid"], report["errors"]
+            )
+        )
+        if report["cancelled"]:
+            return EXIT_CANCELLED
+        return EXIT_OK if report["ok"] else EXIT_FAILED
+
+    def remove_command(self, args):
+        self.hgbcore.remove_target(args[0])
+        return EXIT_OK
+
+    def add_command(self, args):
+        if args[0] in self.hgbcore.config["targets"]:
+            print("Target {} is already defined.".format(args[0]))
+            return EXIT_USAGE
+        self.hgbcore.add_target(*args)
+        return EXIT_OK
+
+    def action_command(self, action, name):
+        # single action on a single target: keep the human-readable behaviour
+        target = self.check_target(name)
+        if target is None:
+            return EXIT_UNAVAILABLE
+        target["report"] = {}
+        signal.signal(signal.SIGINT, self.interrupt)
+        report = self.run_action(action, target)
+        if self.hgbcore.cancel_event.is_set():
+            return EXIT_CANCELLED
+        return EXIT_OK if report.get("ok", True) else EXIT_FAILED
+
+    def batch_command(self, argv):
+        try:
+            args, actions = self.parse_batch(argv)
+        except SystemExit as e:
+            return e.code
+        names, unmatched = self.match_targets(args.targets, args.all)
+        for pattern in unmatched:
+            print("Target {} is not defined.".format(pattern), file=sys.stderr)
+        out = sys.stdout
+        options = vars(args)
+        signal.signal(signal.SIGINT, self.interrupt)
+        if args.format == "text":
+            exit_code = self.run_batch(
+                actions, names, args.format, args.keep_going, options=options
+            )
+        else:
+            # keep stdout clean for machine-readable output
+            with contextlib.redirect_stdout(sys.stderr):
+                exit_code = self.run_batch(
+                    actions, names, args.format, args.keep_going, out=out, options=options
+                )
+        if unmatched:
+            exit_code = max(exit_code, EXIT_UNAVAILABLE)
+        return exit_code
+
+    def parse_command_line(self, argv):
+        command = COMMANDS.get(argv[1]) if len(argv) >= 2 else None
+        if command is not None:
+            method, min_args, max_args = command
+            args = argv[2:]
+            if len(args) < min_args or (max_args is not None and len(args) > max_args):
+                return self.usage()
+            return getattr(self, method)(args)
+        if len(argv) == 3 and argv[1] in ACTIONS and argv[2] in self.hgbcore.config["targets"]:
+            return self.action_command(argv[1], argv[2])
+        if len(argv) >= 3:
+            return self.batch_command(argv)
+        return self.usage()
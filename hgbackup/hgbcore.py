@@ -1,22 +1,482 @@
 import os
 import glob
+import gzip
+import fnmatch
+import tempfile
 import subprocess
 import json
 import uuid
 import time
+import re
+import hashlib
+import math
+import random
+import shutil
+import fcntl
+import heapq
+import itertools
+import threading
+import functools
+import contextlib
+import concurrent.futures
+from collections import OrderedDict
+
+from .hgbjobs import current_job, format_rate
+from .hgbwatch import HGBChangeTracker
 from datetime import datetime
 
 CONFIG_FILE = os.path.join(os.environ["HOME"], "hgbackup.json")
+HASH_BLOCK_SIZE = 1024 * 1024
+# minimum number of verified files before an error rate limit can abort a verification
+MIN_ERROR_RATE_SAMPLE = 100
+# files of at least this size get per-chunk digests, to localize and parallelize verification
+CHUNK_THRESHOLD = 1024 * 1024 * 1024
+CHUNK_SIZE = 64 * 1024 * 1024
+# itemized rsync output of changed or deleted files, directories, links, devices and specials
+RSYNC_CHANGE = re.compile(r"^(\*deleting|[<>ch.][fdLDS])")
+# rsync --progress output, which is not logged
+RSYNC_PROGRESS = re.compile(r"^\s+[\d,.]+[KMGT]?\s+\d+%")
+# maximum number of entries of the persistent digest cache (least recently used are evicted)
+DIGEST_CACHE_SIZE = 1000000
+# number of logs kept per source and log directory, and their maximum total size (in bytes)
+LOG_KEEP = 100
+LOG_MAX_SIZE = 1024 * 1024 * 1024
+# number of backups per path kept in the change index
+CHANGE_INDEX_HISTORY = 20
+# keys of the targets that are stored in the configuration file (the others are runtime state)
+CONFIG_KEYS = [
+    "src",
+    "dst",
+    "id",
+    "last_backup",
+    "last_check",
+    "per_backup",
+    "per_check",
+    "exclude",
+    "optional",
+]
+# maximum time in seconds to wait for the destinations to respond (e.g. offline network mounts)
+PROBE_TIMEOUT = 2
+# number of files restored in parallel
+RESTORE_WORKERS = 4
+# c.f. /usr/include/linux/fs.h
+FICLONE = 0x40049409
+# z-score for the confidence bounds of sampled verifications (95%)
+SAMPLE_CONFIDENCE_Z = 1.96
+# sampled verifications only look up the sizes of a uniform sample of this many times the
+# sample size, to stratify it, instead of those of all entries
+SAMPLE_OVERSAMPLING = 10
+
+
+@contextlib.contextmanager
+def atomic_write(path, sync=True):
+    # write to a temporary file that replaces path once it is complete, so that neither a crash
+    # nor a concurrent reader ever sees a partial file; with sync, the data and the rename are on
+    # disk when this returns (files that can be rebuilt are written without sync)
+    tmp = "{}.tmp{}_{}".format(path, os.getpid(), threading.get_ident())
+    try:
+        with open(tmp, "w") as f:
+            yield f
+            if sync:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+    if sync:
+        fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+
+@contextlib.contextmanager
+def file_lock(path):
+    # exclusive lock, also across processes (released if the process dies)
+    with open(path, "a") as f:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+def file_identity(path):
+    # identifies the version of a file written with atomic_write (which replaces the inode)
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st.st_ino, st.st_mtime_ns
+
+
+def with_target_lock(fn):
+    # methods taking a target as first argument that modify its dictionaries on dst
+    @functools.wraps(fn)
+    def wrapper(self, target, *args, **kwargs):
+        with self.target_lock(target):
+            return fn(self, target, *args, **kwargs)
+
+    return wrapper
+
+
+def wilson_interval(errors, n, z=SAMPLE_CONFIDENCE_Z):
+    # c.f. https://en.wikipedia.org/wiki/Binomial_proportion_confidence_interval
+    if n == 0:
+        return 0.0, 1.0
+    p = errors / n
+    denominator = 1 + z * z / n
+    center = (p + z * z / (2 * n)) / denominator
+    margin = z * math.sqrt(p * (1 - p) / n + z * z / (4 * n * n)) / denominator
+    return max(0.0, center - margin), min(1.0, center + margin)
+
+
+def md5sum(path):
+    # raises OSError if the file cannot be read (e.g. on a failing disk)
+    md5 = hashlib.md5()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b""):
+            md5.update(block)
+    return md5.hexdigest()
+
+
+def md5sum_chunks(path, chunk_size):
+    # MD5 sum of the whole file and of each chunk, in a single pass
+    md5 = hashlib.md5()
+    digests = []
+    with open(path, "rb") as f:
+        while True:
+            chunk_md5 = hashlib.md5()
+            remaining = chunk_size
+            while remaining:
+                block = f.read(min(HASH_BLOCK_SIZE, remaining))
+                if not block:
+                    break
+                md5.update(block)
+                chunk_md5.update(block)
+                remaining -= len(block)
+            if remaining == chunk_size:
+                break
+            digests.append(chunk_md5.hexdigest())
+            if remaining:
+                break
+    return md5.hexdigest(), digests
+
+
+def md5sum_range(path, offset, size):
+    md5 = hashlib.md5()
+    with open(path, "rb") as f:
+        f.seek(offset)
+        while size:
+            block = f.read(min(HASH_BLOCK_SIZE, size))
+            if not block:
+                break
+            md5.update(block)
+            size -= len(block)
+    return md5.hexdigest()
+
+
+def verify_chunks(path, chunk_size, digests, fail_fast=False):
+    # hash the chunks in parallel (hashlib and file reads release the GIL) and return the byte
+    # ranges of invalid chunks; in fail-fast mode, stop at the first invalid chunk
+    size = os.path.getsize(path)
+    if not chunk_size * (len(digests) - 1) < size <= chunk_size * len(digests):
+        return [(0, size)]  # size does not match the number of chunks
+    ranges = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+        futures = {
+            executor.submit(md5sum_range, path, i * chunk_size, chunk_size): i
+            for i in range(len(digests))
+        }
+        for future in concurrent.futures.as_completed(futures):
+            i = futures[future]
+            if future.result() != digests[i]:
+                ranges.append((i * chunk_size, min((i + 1) * chunk_size, size)))
+                if fail_fast:
+                    for f in futures:
+                        f.cancel()
+                    break
+    return sorted(ranges)
+
+
+def copy_file(src, dst, expected=None):
+    # copy src to dst and return its MD5 sum (None if expected is None); the file is cloned if the
+    # file system supports it (and then read once to be verified), otherwise it is hashed while
+    # being copied, or copied in the kernel (copy_file_range) if there is nothing to verify
+    with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+        try:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+            return md5sum(dst) if expected is not None else None
+        except OSError:
+            pass
+        if expected is None:
+            try:
+                size = os.fstat(fsrc.fileno()).st_size
+                while os.copy_file_range(fsrc.fileno(), fdst.fileno(), size):
+                    pass
+                return None
+            except OSError:
+                fsrc.seek(0)
+                fdst.seek(0)
+                fdst.truncate()
+        md5 = hashlib.md5()
+        for block in iter(lambda: fsrc.read(HASH_BLOCK_SIZE), b""):
+            md5.update(block)
+            fdst.write(block)
+        return md5.hexdigest() if expected is not None else None
+
+
+def restore_file(path, f, expected, dest):
+    # restore f as path below dest, unless it does not match the expected MD5 sum (if known);
+    # returns None, or a description of the bad entry
+    out = os.path.join(dest, path)
+    tmp = out + ".hgbrestore"
+    try:
+        os.makedirs(os.path.dirname(out), exist_ok=True)
+        got = copy_file(f, tmp, expected)
+        if got != expected:
+            os.remove(tmp)
+            return {"path": path, "expected": expected, "got": got, "error": None}
+        shutil.copystat(f, tmp)
+        os.replace(tmp, out)
+    except OSError as e:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        return {"path": path, "expected": expected, "got": None, "error": str(e)}
+    return None
+
+
+def rotate_logs(logdir, name):
+    # make room for a new log of the given source, by removing the oldest ones beyond LOG_KEEP or
+    # LOG_MAX_SIZE (compressed logs as well as uncompressed ones of older versions, whose exclude
+    # and file lists are removed right away)
+    pattern = re.compile(
+        re.escape(name) + r"_\d{4}-\d{2}-\d{2}_\d{2}:\d{2}:\d{2}(_\w+)?\.(log|log\.gz|exc|lst)$"
+    )
+    files = [f for f in os.listdir(logdir) if pattern.match(f)]
+    for f in files:
+        if f.endswith((".exc", ".lst")):
+            os.remove(os.path.join(logdir, f))
+    logs = sorted(
+        (f for f in files if not f.endswith((".exc", ".lst"))),
+        key=lambda f: f[len(name) + 1 : len(name) + 20],
+        reverse=True,
+    )
+    total = 0
+    for i, f in enumerate(logs):
+        path = os.path.join(logdir, f)
+        total += os.path.getsize(path)
+        if i >= LOG_KEEP - 1 or total > LOG_MAX_SIZE:
+            os.remove(path)
+
+
+def read_change_index(indexfile):
+    # the change index holds the timestamps of the last backups that changed each path, as lines
+    # "<path>\t<timestamp> <timestamp> ..." sorted by path (most recent timestamp first)
+    if not os.path.isfile(indexfile):
+        return
+    with open(indexfile) as f:
+        for line in f:
+            path, history = line.rstrip("\n").split("\t")
+            yield path, history.split()
+
+
+def update_change_index(indexfile, timestamp, changes):
+    # merge the sorted changes of a backup into the index, in a single pass
+    entries = read_change_index(indexfile)
+    entry = next(entries, None)
+    with atomic_write(indexfile, sync=False) as f:
+        for path in sorted(set(changes)):
+            while entry is not None and entry[0] < path:
+                f.write("{}\t{}\n".format(entry[0], " ".join(entry[1])))
+                entry = next(entries, None)
+            history = [timestamp]
+            if entry is not None and entry[0] == path:
+                history += entry[1][: CHANGE_INDEX_HISTORY - 1]
+                entry = next(entries, None)
+            f.write("{}\t{}\n".format(path, " ".join(history)))
+        while entry is not None:
+            f.write("{}\t{}\n".format(entry[0], " ".join(entry[1])))
+            entry = next(entries, None)
+
+
+def probe_destination(dst, cached=None):
+    # returns the ID of a destination and the files in its .hgbackup folder, or None if it is not
+    # available; the ID file is only read if it changed since the cached probe
+    dst_conf_dir = os.path.join(dst, ".hgbackup")
+    try:
+        files = set(os.listdir(dst_conf_dir))
+        st = os.stat(os.path.join(dst_conf_dir, "id"))
+        identity = (st.st_dev, st.st_ino, st.st_mtime_ns)
+        if cached is not None and cached[0] == identity:
+            id = cached[1]
+        else:
+            with open(os.path.join(dst_conf_dir, "id")) as f:
+                id = f.read().strip()
+    except OSError:
+        return None
+    return identity, id, files
+
+
+def read_verfile(verfile):
+    # stream the entries of a verification file as (path, MD5 sum), sorted by path; files written
+    # by older versions are not sorted, and need to be sorted in memory
+    def entries():
+        with open(verfile) as f:
+            for line in f:
+                md5, path = line.rstrip().split(" ", 1)
+                yield path, md5
+
+    previous = None
+    for path, md5 in entries():
+        if previous is not None and path <= previous:
+            yield from sorted(entries())
+            return
+        previous = path
+    yield from entries()
+
+
+def diff_verfiles(verfiles):
+    # merge-join the sorted verification files, yielding (path, [MD5 sum or None per file]) for
+    # the paths that are missing in some of the files or whose MD5 sums differ; hard links ("HL")
+    # match any MD5 sum, as which of the links is recorded as such depends on the transfer order
+    def tagged(i, verfile):
+        for path, md5 in read_verfile(verfile):
+            yield path, i, md5
+
+    merged = heapq.merge(*[tagged(i, verfile) for i, verfile in enumerate(verfiles)])
+    for path, group in itertools.groupby(merged, key=lambda entry: entry[0]):
+        md5s = [None] * len(verfiles)
+        for _, i, md5 in group:
+            md5s[i] = md5
+        if None in md5s or len(set(md5 for md5 in md5s if md5 != "HL")) > 1:
+            yield path, md5s
+
+
+class ConnectionProbe:
+    # probes a destination in a daemon thread, so that a hung mount neither blocks the caller
+    # (who waits with a timeout) nor the exit of the program
+
+    def __init__(self, dst, cached):
+        self.dst = dst
+        self.cached = cached
+        self.result = None
+        self.done = threading.Event()
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def run(self):
+        try:
+            self.result = probe_destination(self.dst, self.cached)
+        finally:
+            self.done.set()
+
+
+class DigestCache:
+    # MD5 sums keyed by inode, so that hard-linked files are read only once. Entries are only
+    # valid as long as size and modification time of the inode are unchanged. As bit rot does not
+    # change those, verifications only trust digests computed during the current run, which are
+    # kept in memory only, while digests of source files (e.g. for repairs) are persisted and also
+    # taken from previous runs.
+
+    def __init__(self, cache_file):
+        self.cache_file = cache_file
+        self.entries = None  # (dev, ino) -> [size, mtime_ns, md5], persisted
+        self.current = {}  # (dev, ino) -> [size, mtime_ns, md5], of the current run only
+        self.modified = False
+        self.lock = threading.Lock()
+
+    def load(self):
+        self.entries = OrderedDict()
+        if self.cache_file is None or not os.path.isfile(self.cache_file):
+            return
+        with open(self.cache_file) as f:
+            for line in f:
+                try:
+                    dev, ino, size, mtime_ns, md5 = line.split()
+                    self.entries[(int(dev), int(ino))] = [int(size), int(mtime_ns), md5]
+                except ValueError:
+                    continue  # skip corrupt lines, the cache can always be rebuilt
+
+    def save(self):
+        with self.lock:
+            if not self.modified or self.cache_file is None:
+                return
+            with atomic_write(self.cache_file, sync=False) as f:
+                for (dev, ino), (size, mtime_ns, md5) in self.entries.items():
+                    f.write("{} {} {} {} {}\n".format(dev, ino, size, mtime_ns, md5))
+            self.modified = False
+
+    def new_run(self):
+        with self.lock:
+            if self.entries is None:
+                self.load()
+            self.current = {}
+
+    def lookup(self, st, trusted):
+        key = (st.st_dev, st.st_ino)
+        with self.lock:
+            if self.entries is None:
+                self.load()
+            entry = self.current.get(key)
+            if entry is None and trusted:
+                entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] != st.st_size or entry[1] != st.st_mtime_ns:
+                # the inode changed (or was reused)
+                self.current.pop(key, None)
+                if self.entries.pop(key, None) is not None:
+                    self.modified = True
+                return None
+            if key in self.entries:
+                self.entries.move_to_end(key)
+            return entry[2]
+
+    def store(self, st, md5, persistent=False):
+        # only digests that later runs can use (i.e. of source files) are persisted
+        with self.lock:
+            if self.entries is None:
+                self.load()
+            key = (st.st_dev, st.st_ino)
+            self.current[key] = [st.st_size, st.st_mtime_ns, md5]
+            if not persistent:
+                return
+            self.entries[key] = [st.st_size, st.st_mtime_ns, md5]
+            self.entries.move_to_end(key)
+            while len(self.entries) > DIGEST_CACHE_SIZE:
+                self.entries.popitem(last=False)
+            self.modified = True
+
+    def md5sum(self, path, trusted=False):
+        # trusted: also take (and persist) digests of previous runs
+        st = os.stat(path)
+        md5 = self.lookup(st, trusted)
+        if md5 is None:
+            md5 = md5sum(path)
+            self.store(st, md5, persistent=trusted)
+        return md5
 
 
 class HGBCore:
     i = 0
-    percentage = 0
     length = 0
-    thread = None
+    progress_started = 0
     config = {"targets": {}}
+    config_mtime = None
+    chunk_threshold = CHUNK_THRESHOLD
+    chunk_size = CHUNK_SIZE
 
     def __init__(self, config_file=CONFIG_FILE):
+        self.cancel_event = threading.Event()
+        self.digests = DigestCache(os.path.splitext(config_file)[0] + ".digests")
+        self.tracker = None
+        self.probes = {}  # dst -> last ConnectionProbe
+        self.identities = {}  # dst -> (stat of the ID file, ID)
+        self.held_locks = threading.local()  # target locks held by the current thread
+        self.locked = set()  # target locks held by any thread of this process
         try:
             self.config_file = config_file
             self.load_config()
@@ -24,35 +484,71 @@ class HGBCore:
             print("Could not load config: " + str(e))
 
     def new_progress(self, label, length):
+        job = current_job.get()
+        if job is not None:
+            job.new_progress(label, length)
+            return
         self.i = 0
-        self.percentage = 0
         self.length = length
-        if self.thread is None:
-            print(label + "..." + ("done" if not self.length else ""))
-        else:
-            self.thread.new_progress.emit(label, length)
+        self.progress_started = time.time()
+        print(label + "..." + ("done" if not self.length else ""))
 
     def inc_progress(self):
+        job = current_job.get()
+        if job is not None:
+            job.inc_progress()
+            return
         self.i += 1
-        if self.thread is None:
-            print("\r{}/{}".format(self.i, self.length), end="")
-        else:
-            if self.i / self.length * 100 >= self.percentage + 1:
-                self.percentage += 1
-                self.thread.set_progress.emit(self.percentage)
+        rate = format_rate(self.i, self.length, time.time() - self.progress_started)
+        print("\r{}/{} ({})".format(self.i, self.length, rate), end="")
 
     def done_progress(self):
-        if self.thread is None and self.length:
+        job = current_job.get()
+        if job is not None:
+            job.done_progress()
+        elif self.length:
             if self.i:
                 print("\r...done        ")
             else:
                 print("...done")
-        elif self.thread is not None:
-            self.thread.done_progress.emit()
 
-    def load_config(self):
-        if not os.path.exists(self.config_file):
-            self.save_config()
+    def cancelled(self):
+        # cooperative cancellation, requested through the current job or (e.g. from a signal
+        # handler of the CLI) through cancel_event
+        job = current_job.get()
+        return self.cancel_event.is_set() or (job is not None and job.cancelled.is_set())
+
+    def emit(self, event, *args):
+        # notify the subscribers of the job engine (if running as a job)
+        job = current_job.get()
+        if job is not None:
+            job.emit(event, *args)
+
+    def start_tracker(self):
+        # track changes under the src of all targets in the background, so that backups from
+        # this (long-running) process can be incremental
+        try:
+            self.tracker = HGBChangeTracker()
+        except (OSError, AttributeError) as e:
+            print("Change tracking is not available: {}".format(e))
+            return
+        targets = [(name, target["src"]) for name, target in self.config["targets"].items()]
+        threading.Thread(
+            target=lambda: [self.tracker.track(name, src) for name, src in targets], daemon=True
+        ).start()
+
+    def stop_tracker(self):
+        if self.tracker is not None:
+            self.tracker.stop()
+            self.tracker = None
+
+    def target_name(self, target):
+        for name, t in self.config["targets"].items():
+            if t is target:
+                return name
+        return None
+
+    def read_config_file(self):
         with open(self.config_file, "r") as json_file:  # raises exception if file not found
             data = json.load(json_file)  # raises exception if JSON file corrupt
             if ("targets" not in data) or (not isinstance(data["targets"], dict)):
@@ -73,34 +569,111 @@ class HGBCore:
                         "Path does not exist or is not a directory: {}".format(target["src"])
                     )
                 target["dst_connected"] = False
-                self.update_target_connection(target)
-        self.config = data
-
-    def save_config(self):
-        data = {"targets": {}}  # make a dictionary to store config
-        keys = [
-            "src",
-            "dst",
-            "id",
-            "last_backup",
-            "last_check",
-            "per_backup",
-            "per_check",
-            "exclude",
-            "optional",
-        ]  # keys to be stored
-        for name, target in self.config["targets"].items():
-            data["targets"][name] = {}
-            for key in keys:
-                data["targets"][name][key] = target[key]
-        with open(self.config_file, "w") as json_file:
-            json.dump(data, json_file, indent=4)
+        return data
+
+    def load_config(self):
+        if not os.path.exists(self.config_file):
+            self.save_config()
+        self.config_mtime = os.stat(self.config_file).st_mtime_ns
+        self.config = self.read_config_file()
+        self.update_connections()
+
+    def reload_config(self):
+        # cheap reload if the configuration file changed (e.g. saved by another process): the
+        # runtime state of the targets is kept, only new or moved targets are probed; returns
+        # whether the configuration was reloaded; an invalid file (e.g. while being edited, or
+        # with a src that is not mounted) is reported and retried the next time
+        try:
+            mtime = os.stat(self.config_file).st_mtime_ns
+            if mtime == self.config_mtime:
+                return False
+            data = self.read_config_file()
+        except Exception as e:
+            print("Cannot reload the configuration: {}".format(e))
+            return False
+        self.config_mtime = mtime
+        targets = self.config["targets"]
+        for name in [name for name in targets if name not in data["targets"]]:
+            del targets[name]
+            if self.tracker is not None:
+                self.tracker.untrack(name)
+        probe = []
+        for name, target in data["targets"].items():
+            current = targets.get(name)
+            if current is not None and all(current[k] == target[k] for k in ["src", "dst", "id"]):
+                current.update({key: target[key] for key in CONFIG_KEYS if key in target})
+                continue
+            targets[name] = target
+            probe.append(name)
+            if self.tracker is not None:
+                self.tracker.track(name, target["src"])
+        if probe:
+            self.update_connections(probe)
+        return True
+
+    def save_config(self, names=None, removed=(), keys=None):
+        # merge the given targets (by default all) into the configuration file, under a short
+        # lock, so that processes (or jobs) saving different targets keep each other's changes;
+        # with keys, only those are merged into targets already in the file (e.g. the time of the
+        # last backup), so that concurrent edits of the same target are kept as well
+        if names is None:
+            names = list(self.config["targets"])
+        with file_lock(self.config_file + ".lock"):
+            data = {"targets": {}}
+            mtime = None
+            if os.path.exists(self.config_file):
+                mtime = os.stat(self.config_file).st_mtime_ns
+                with open(self.config_file) as json_file:
+                    data = json.load(json_file)
+            for name in removed:
+                data["targets"].pop(name, None)
+            for name in names:
+                target = self.config["targets"][name]
+                if keys is not None and name in data["targets"]:
+                    data["targets"][name].update({key: target[key] for key in keys})
+                else:
+                    data["targets"][name] = {key: target[key] for key in CONFIG_KEYS}
+            with atomic_write(self.config_file) as json_file:
+                json.dump(data, json_file, indent=4)
+            # changes of other processes since the last load are still to be reloaded
+            if mtime == self.config_mtime:
+                self.config_mtime = os.stat(self.config_file).st_mtime_ns
+
+    def lock_file(self, target):
+        return target["verfile"][: -len(".ver")] + ".lock"
+
+    @contextlib.contextmanager
+    def target_lock(self, target):
+        # exclusive access to the dictionaries of a target on its dst, also across processes (e.g.
+        # the GUI and a cron job); the lock is not waited for, as backups may take hours
+        if not target["dst_connected"]:
+            raise Exception("Target is not connected: {}".format(target["dst"]))
+        lockfile = self.lock_file(target)
+        held = self.held_locks.__dict__.setdefault("files", set())
+        if lockfile in held:  # nested call
+            yield
+            return
+        with open(lockfile, "a") as f:
+            try:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                raise Exception("Target is in use by another process: {}".format(target["dst"]))
+            held.add(lockfile)
+            self.locked.add(lockfile)
+            try:
+                yield
+            finally:
+                self.locked.discard(lockfile)
+                held.discard(lockfile)
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
 
     def remove_target(self, targetname):
         if targetname not in self.config["targets"]:
             raise Exception("Target {} is not defined.".format(targetname))
         del self.config["targets"][targetname]
-        self.save_config()
+        self.save_config(names=[], removed=[targetname])
+        if self.tracker is not None:
+            self.tracker.untrack(targetname)
 
     def add_target(self, targetname, src, dst):
         # remove trailing / from src and dst
@@ -128,6 +701,35 @@ class HGBCore:
         if not os.path.isdir(dst):
             raise Exception("Please make sure the destination is a folder: {}".format(dst))
 
+        id = self.init_destination(src, dst)
+        if os.path.basename(src) in [
+            os.path.basename(x) for x in glob.glob(os.path.join(dst, "*"))
+        ]:
+            print(
+                "The destination already contains a folder named {}. If it's not a backup, you "
+                "might want to move it. It it's a backup, you might want to check the verification "
+                "file.".format(os.path.basename(src))
+            )
+
+        self.config["targets"][targetname] = {
+            "src": src,
+            "dst": dst,
+            "id": id,
+            "last_backup": None,
+            "last_check": None,
+            "per_backup": None,
+            "per_check": None,
+            "exclude": [],
+            "optional": [],
+        }
+        self.save_config(names=[targetname])
+
+        self.load_config()
+        if self.tracker is not None:
+            self.tracker.track(targetname, src)
+
+    def init_destination(self, src, dst):
+        # returns the ID of dst, creating it along with the verification file of src if needed
         # check dst for ID file
         dst_conf_dir = os.path.join(dst, ".hgbackup")
         idfile = os.path.join(dst_conf_dir, "id")
@@ -153,50 +755,52 @@ class HGBCore:
                 f.write(id)
             with open(verfile, "w") as f:
                 pass
-        if os.path.basename(src) in [
-            os.path.basename(x) for x in glob.glob(os.path.join(dst, "*"))
-        ]:
-            print(
-                "The destination already contains a folder named {}. If it's not a backup, you "
-                "might want to move it. It it's a backup, you might want to check the verification "
-                "file.".format(os.path.basename(src))
-            )
+        return id
 
-        self.config["targets"][targetname] = {
-            "src": src,
-            "dst": dst,
-            "id": id,
-            "last_backup": None,
-            "last_check": None,
-            "per_backup": None,
-            "per_check": None,
-            "exclude": [],
-            "optional": [],
-        }
-        self.save_config()
+    def probe_destinations(self, dsts, timeout=PROBE_TIMEOUT):
+        # probe the destinations concurrently; those that do not respond in time are left out of
+        # the results, as their state is unknown (a hung probe is waited for again instead of
+        # starting another one)
+        for dst in dsts:
+            probe = self.probes.get(dst)
+            if probe is None or probe.done.is_set():
+                self.probes[dst] = ConnectionProbe(dst, self.identities.get(dst))
+        deadline = time.time() + timeout
+        results = {}
+        for dst in dsts:
+            probe = self.probes[dst]
+            if probe.done.wait(max(0, deadline - time.time())):
+                results[dst] = probe.result
+                if probe.result is not None:
+                    self.identities[dst] = probe.result[:2]
+        return results
 
-        self.load_config()
+    def update_connections(self, names=None, timeout=PROBE_TIMEOUT):
+        # update the connection status of the given (by default all) targets, probing each
+        # destination only once; returns target name -> (connected, toggled); targets removed
+        # meanwhile (e.g. by a reload of the configuration in another thread) are skipped
+        if names is None:
+            names = list(self.config["targets"])
+        targets = {name: self.config["targets"].get(name) for name in names}
+        targets = {name: target for name, target in targets.items() if target is not None}
+        results = self.probe_destinations(set(t["dst"] for t in targets.values()), timeout)
+        return {
+            name: self.set_target_connection(target, results) for name, target in targets.items()
+        }
 
-    def update_target_connection(self, target):
-        dst_connected = True
+    def update_target_connection(self, target, timeout=PROBE_TIMEOUT):
+        return self.set_target_connection(target, self.probe_destinations([target["dst"]], timeout))
 
-        dst_conf_dir = os.path.join(target["dst"], ".hgbackup")
-        if os.path.isdir(dst_conf_dir):
-            # check if target has the correct ID
-            idfile = os.path.join(dst_conf_dir, "id")
-            if not os.path.isfile(idfile):
-                dst_connected = False
-            else:
-                with open(idfile) as f:
-                    id = f.read().strip()
-                    if not id == target["id"]:
-                        dst_connected = False
-        else:
-            dst_connected = False
-        # check target for verification file
-        verfile = os.path.join(dst_conf_dir, os.path.basename(target["src"]) + ".ver")
-        if not os.path.isfile(verfile):
-            dst_connected = False
+    def set_target_connection(self, target, results):
+        # targets whose destination did not respond in time keep their state
+        if target["dst"] not in results:
+            return target["dst_connected"], False
+        probe = results[target["dst"]]
+        # check that the destination has the correct ID and a verification file for the target
+        verfile = os.path.join(target["dst"], ".hgbackup", os.path.basename(target["src"]) + ".ver")
+        dst_connected = (
+            probe is not None and probe[1] == target["id"] and os.path.basename(verfile) in probe[2]
+        )
 
         if dst_connected and target["dst_connected"]:  # do nothing, target stays connecteed
             return True, False
@@ -204,11 +808,20 @@ class HGBCore:
             target["dst_connected"] = dst_connected
             target["verfile"] = verfile
             target["verdict"] = None
+            target["chunkfile"] = verfile[: -len(".ver")] + ".chk"
+            target["chunks"] = None
+            target["chunks_modified"] = False
             return True, True
+        elif target["dst_connected"] and self.lock_file(target) in self.locked:
+            # a job of this process uses the target, it fails by itself if dst is really gone
+            return True, False
         elif not dst_connected and target["dst_connected"]:  # target just got disconnected
             target["dst_connected"] = dst_connected
             target["verfile"] = None
             target["verdict"] = None
+            target["chunkfile"] = None
+            target["chunks"] = None
+            target["chunks_modified"] = False
             return False, True
         else:  # do nothing, target stays disconnected
             return False, False
@@ -231,29 +844,115 @@ class HGBCore:
         if target["verdict"] is None or target["verfile"] is None:
             raise Exception("Verification dictionary not loaded")
         print("Saving verification file...")
-        with open(target["verfile"], "w") as f:
-            for key in target["verdict"]:
+        # sorted, so that verification files can be compared without loading them
+        with atomic_write(target["verfile"]) as f:
+            for key in sorted(target["verdict"]):
                 f.write("{} {}\n".format(target["verdict"][key], key))
+        target["verstat"] = file_identity(target["verfile"])
+
+    def load_chunks(self, target):
+        # the chunk file holds per-chunk digests of large files, each line consisting of the MD5
+        # sum of the whole file (the digests are only valid as long as it matches the
+        # verification dictionary), the chunk size, the comma-separated chunk digests and the path
+        if not target["dst_connected"]:
+            raise Exception("Target is not connected: {}".format(target["dst"]))
+        chunks = {}
+        if os.path.isfile(target["chunkfile"]):
+            with open(target["chunkfile"]) as f:
+                for line in f:
+                    md5, chunk_size, digests, path = line.rstrip().split(" ", 3)
+                    chunks[path] = (md5, int(chunk_size), digests.split(","))
+        return chunks
+
+    def save_chunks(self, target):
+        if not target["dst_connected"]:
+            raise Exception("Target is not connected: {}".format(target["dst"]))
+        if target["chunks"] is None or target["verdict"] is None:
+            raise Exception("Chunk dictionary not loaded")
+        with atomic_write(target["chunkfile"]) as f:
+            for key, (md5, chunk_size, digests) in target["chunks"].items():
+                if target["verdict"].get(key) != md5:
+                    continue  # outdated, the file was modified or deleted
+                f.write("{} {} {} {}\n".format(md5, chunk_size, ",".join(digests), key))
+        target["chunks_modified"] = False
+        target["chunkstat"] = file_identity(target["chunkfile"])
+
+    def prepare_chunks(self, target):
+        if target["chunks"] is None:
+            target["chunkstat"] = file_identity(target["chunkfile"])
+            target["chunks"] = self.load_chunks(target)
+        return target["chunks"]
 
     def prepare_target(self, target):
+        # the dictionaries are reloaded if another process saved them since they were loaded
+        # (e.g. a backup by a cron job while the GUI is running), as they would be overwritten
+        # with stale entries otherwise
+        if not target["dst_connected"]:
+            raise Exception("Target is not connected: {}".format(target["dst"]))
+        identity = file_identity(target["verfile"])
+        if target["verdict"] is not None and identity != target.get("verstat"):
+            print("Verification file changed, reloading...")
+            target["verdict"] = None
+            target["chunks"] = None
+            target["chunks_modified"] = False
         if target["verdict"] is None:
+            target["verstat"] = identity
             target["verdict"] = self.load_verdict(target)
+        if target["chunks"] is not None and not target["chunks_modified"]:
+            if file_identity(target["chunkfile"]) != target.get("chunkstat"):
+                target["chunks"] = None
 
         return target["src"], target["dst"], target["verdict"]
 
     def check_verdict(self, target, repair=False):
-        t0 = time.time()
-        src, dst, verdict = self.prepare_target(target)
+        # only a repair modifies the dictionary
+        with self.target_lock(target) if repair else contextlib.nullcontext():
+            t0 = time.time()
+            src, dst, verdict = self.prepare_target(target)
+            self.digests.new_run()
 
+            missing_files = self.scan_missing_files(dst, verdict, repair)
+            files = self.scan_dst_files(src, dst)
+            missing_checksums, unresolved = self.scan_missing_checksums(
+                src, dst, verdict, files, repair
+            )
+
+            cancelled = self.cancelled()
+            if cancelled:
+                print("\nCancelled, the results are incomplete.")
+
+            if repair:
+                # when cancelled, this keeps the repairs done so far
+                self.save_verdict(target)
+                self.digests.save()
+            else:
+                unresolved = missing_files + missing_checksums
+
+            target["report"] = {
+                "entries": len(verdict),
+                "files": len(files),
+                "missing_files": missing_files,
+                "missing_checksums": missing_checksums,
+                "repaired": repair,
+                "cancelled": cancelled,
+                "seconds": time.time() - t0,
+                "ok": unresolved == 0 and not cancelled,
+            }
+
+            print("\n-- The operation took {:.1f} seconds.".format(time.time() - t0))
+
+    def scan_missing_files(self, dst, verdict, repair):
+        # returns the number of entries whose file is missing on dst, with repair they are removed
         remove_list = []
         self.new_progress("Scanning for missing files", len(verdict))
         for key in verdict:
+            if self.cancelled():
+                break
             self.inc_progress()
             # check if file exists
             if not os.path.exists(os.path.join(dst, key)):
                 print("\r  File not found: {}".format(key))
-                if repair:
-                    remove_list.append(key)
+                remove_list.append(key)
         self.done_progress()
 
         if repair:
@@ -262,86 +961,645 @@ class HGBCore:
                 self.inc_progress()
                 verdict.pop(key, None)
             self.done_progress()
+        return len(remove_list)
 
+    def scan_dst_files(self, src, dst):
         self.new_progress("Scanning dst directory", 1)
         files = []
         for dirpath, dirnames, filenames in os.walk(
             os.path.join(dst, os.path.basename(src))
         ):  # does not follow links
+            if self.cancelled():
+                break
             for f in filenames:
                 f = os.path.join(dirpath, f)
                 if not os.path.islink(f):
                     files.append(f)
         self.done_progress()
+        return files
 
+    def scan_missing_checksums(self, src, dst, verdict, files, repair):
+        # returns the number of files on dst without an entry, and of those that could not be
+        # repaired (with repair, the MD5 sums are taken from the source files)
+        missing_checksums = 0
+        unresolved = 0
         self.new_progress("Scanning for missing checksums", len(files))
         for f in files:
+            if self.cancelled():
+                break
             self.inc_progress()
             # check if MD5 sum exists
             relf = os.path.relpath(f, dst)
-            if relf not in verdict:
-                print("\r  MD5 sum not found: {}".format(relf))
-                if repair:
-                    # read MD5 sum from source file
-                    src_file = os.path.join(os.path.dirname(src), relf)
-                    if os.path.isfile(src_file):
-                        proc = subprocess.Popen(["md5sum", src_file], stdout=subprocess.PIPE)
-                        line = proc.stdout.readline()
-                        verdict[relf] = line.rstrip().decode("utf-8").split(" ", 1)[0]
-                    else:
-                        print("  WARNING: {} not found in source directory".format(relf))
+            if relf in verdict:
+                continue
+            print("\r  MD5 sum not found: {}".format(relf))
+            missing_checksums += 1
+            if not repair:
+                continue
+            # read MD5 sum from source file
+            src_file = os.path.join(os.path.dirname(src), relf)
+            if os.path.isfile(src_file):
+                verdict[relf] = self.digests.md5sum(src_file, trusted=True)
+            else:
+                print("  WARNING: {} not found in source directory".format(relf))
+                unresolved += 1
         self.done_progress()
+        return missing_checksums, unresolved
 
-        if repair:
-            self.save_verdict(target)
+    def select_restore(self, target, pattern, before=None):
+        # files to restore as (path relative to dst, file on dst, expected MD5 sum or None): the
+        # entries of the verification dictionary below or matching pattern, or with before, the
+        # oldest version replaced or deleted by a backup after that time (from rsync_backup)
+        src, dst, verdict = self.prepare_target(target)
+        pattern = pattern.rstrip("/")
+
+        def selected(path):
+            return fnmatch.fnmatchcase(path, pattern) or path.startswith(pattern + "/")
+
+        files = {
+            path: (os.path.join(dst, path), None if md5 == "HL" else md5)
+            for path, md5 in verdict.items()
+            if selected(path)
+        }
+        if before is not None:
+            backupdir = os.path.join(dst, ".hgbackup", "rsync_backup")
+            versions = {}
+            suffix = re.compile(r"^(.*)\.backup_(\d{4}-\d{2}-\d{2}_\d{2}:\d{2}:\d{2})$")
+            for dirpath, dirnames, filenames in os.walk(backupdir):
+                for filename in filenames:
+                    m = suffix.match(filename)
+                    if m is None or m.group(2) <= before:
+                        continue
+                    path = os.path.relpath(os.path.join(dirpath, m.group(1)), backupdir)
+                    if selected(path) and (path not in versions or m.group(2) < versions[path][0]):
+                        versions[path] = (m.group(2), os.path.join(dirpath, filename))
+            # the digests of previous versions are not known
+            files.update({path: (f, None) for path, (timestamp, f) in versions.items()})
+        return files
+
+    def restore(self, target, pattern, dest, before=None, workers=RESTORE_WORKERS):
+        # copy the selected files from dst to dest (keeping their path relative to dst), in
+        # parallel, each one being checked against the verification dictionary while it is
+        # copied; invalid files are not restored
+        t0 = time.time()
+        files = self.select_restore(target, pattern, before)
+        counts = {"restored": 0, "verified": 0, "unverified": 0, "invalid": 0, "errors": 0}
+        bad = []
+
+        self.new_progress("Restoring {} files to {}".format(len(files), dest), len(files))
+        pending = iter(sorted(files.items()))
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            running = {}
+            while True:
+                # keep a bounded number of files in flight
+                self.submit_restores(executor, running, pending, dest, 4 * workers)
+                if not running:
+                    break
+                done, _ = concurrent.futures.wait(
+                    running, return_when=concurrent.futures.FIRST_COMPLETED
+                )
+                for future in done:
+                    self.inc_progress()
+                    self.count_restored(future.result(), running.pop(future), counts, bad)
+        self.done_progress()
+        cancelled = self.cancelled()
+        if cancelled:
+            print("Restore cancelled.")
+
+        target["report"] = dict(
+            counts,
+            files=len(files),
+            bad=bad,
+            cancelled=cancelled,
+            seconds=time.time() - t0,
+            ok=not bad and not cancelled,
+        )
+        return target["report"]
+
+    def submit_restores(self, executor, running, pending, dest, limit):
+        while len(running) < limit and not self.cancelled():
+            item = next(pending, None)
+            if item is None:
+                break
+            path, (f, expected) = item
+            running[executor.submit(restore_file, path, f, expected, dest)] = expected
+
+    def count_restored(self, entry, expected, counts, bad):
+        if entry is None:
+            counts["restored"] += 1
+            counts["verified" if expected is not None else "unverified"] += 1
+            return
+        bad.append(entry)
+        if entry["error"] is not None:
+            counts["errors"] += 1
+            print("\rCould not restore file: {} ({})".format(entry["path"], entry["error"]))
+        else:
+            counts["invalid"] += 1
+            print("\rInvalid checksum, not restored: {}".format(entry["path"]))
+
+    def compare_targets(self, targets, sync=False):
+        # compare the verification dictionaries of backups of the same src on different dst,
+        # without reading the backups; with sync, entries missing in a dictionary are taken from
+        # another one if the file exists on that dst (a verification will tell if it is correct)
+        self.check_comparable(targets)
+        names = [self.target_name(target) for target in targets]
+        t0 = time.time()
+        differing = 0
+        missing = {name: 0 for name in names}
+        synced = {name: {} for name in names}
+        print("Comparing verification dictionaries...")
+        for path, md5s in diff_verfiles([target["verfile"] for target in targets]):
+            if None not in md5s:
+                differing += 1
+                print("Differs: {} ({})".format(path, ", ".join(md5s)))
+                continue
+            known = [md5 for md5 in md5s if md5 not in [None, "HL"]]
+            for name, target, md5 in zip(names, targets, md5s):
+                if md5 is not None:
+                    continue
+                missing[name] += 1
+                print("Missing in {}: {}".format(name, path))
+                if sync and known and os.path.isfile(os.path.join(target["dst"], path)):
+                    synced[name][path] = known[0]
+
+        if sync:
+            self.sync_verdicts(targets, [synced[name] for name in names])
+
+        report = {
+            "targets": names,
+            "differing": differing,
+            "missing": missing,
+            "synced": {name: len(synced[name]) for name in names},
+            "seconds": time.time() - t0,
+            "ok": differing == 0 and not any(missing.values()),
+        }
+        for target in targets:
+            target["report"] = report
+        return report
+
+    def check_comparable(self, targets):
+        for target in targets:
+            if not target["dst_connected"]:
+                raise Exception("Target is not connected: {}".format(target["dst"]))
+        if len(set(os.path.basename(target["src"]) for target in targets)) > 1:
+            raise Exception("Cannot compare backups of different sources")
+
+    def sync_verdicts(self, targets, entries):
+        # add the entries (path -> MD5 sum) to the verification dictionary of each target
+        for target, new in zip(targets, entries):
+            if new:
+                with self.target_lock(target):
+                    self.prepare_target(target)
+                    target["verdict"].update(new)
+                    self.save_verdict(target)
+
+    def check_file(self, target, key, fail_fast=False):
+        # returns None if the file matches its checksum, a description of the bad entry otherwise
+        path = os.path.join(target["dst"], key)
+        expected = target["verdict"][key]
+        entry = {"path": key, "expected": expected, "got": None, "error": None, "ranges": []}
+        try:
+            if os.path.getsize(path) < self.chunk_threshold:
+                entry["got"] = self.digests.md5sum(path)
+            else:
+                st = os.stat(path)
+                entry["got"] = self.digests.lookup(st, trusted=False)
+                if entry["got"] is not None:  # hard link to a file hashed during this run
+                    return None if entry["got"] == expected else entry
+                chunks = self.prepare_chunks(target).get(key)
+                if chunks is not None and chunks[0] == expected:
+                    # only the chunks need to be checked, they were recorded for this checksum
+                    entry["ranges"] = verify_chunks(path, chunks[1], chunks[2], fail_fast)
+                    if not entry["ranges"]:
+                        self.digests.store(st, expected)
+                        return None
+                    return entry
+                entry["got"], digests = md5sum_chunks(path, self.chunk_size)
+                self.digests.store(st, entry["got"])
+                if entry["got"] == expected:
+                    target["chunks"][key] = (expected, self.chunk_size, digests)
+                    target["chunks_modified"] = True
+        except OSError as e:
+            entry["error"] = str(e)
+        return None if entry["got"] == expected else entry
+
+    def open_log(self, dst, kind, src, timestamp, suffix=""):
+        # logs are compressed while they are written, and rotated
+        logdir = os.path.join(dst, ".hgbackup", kind)
+        if not os.path.exists(logdir):
+            os.mkdir(logdir)
+        rotate_logs(logdir, os.path.basename(src))
+        logfile = os.path.join(logdir, os.path.basename(src) + "_" + timestamp + suffix + ".log.gz")
+        return logfile, gzip.open(logfile, "wt", encoding="utf-8")
+
+    def change_index_file(self, target):
+        return target["verfile"][: -len(".ver")] + ".idx"
 
-        print("\n-- The operation took {:.1f} seconds.".format(time.time() - t0))
+    def change_history(self, target, pattern):
+        # paths (relative to dst) matching the glob pattern, with the timestamps of the last
+        # backups that changed them, from the change index (i.e. without reading any logs)
+        for path, history in read_change_index(self.change_index_file(target)):
+            if fnmatch.fnmatchcase(path, pattern):
+                yield path, history
 
-    def verify_backup(self, target):
+    def log_bad_entry(self, log, entry):
+        if entry["error"] is not None:
+            print("\rCould not read file: {} ({})".format(entry["path"], entry["error"]))
+            log.write("Could not read file: {}, error: {}\n".format(entry["path"], entry["error"]))
+        elif entry["ranges"]:
+            ranges = ", ".join("{}-{}".format(start, end) for start, end in entry["ranges"])
+            print("\rInvalid checksum: {} (bytes {})".format(entry["path"], ranges))
+            log.write(
+                "Invalid checksum: {}, expected: {}, invalid byte ranges: {}\n".format(
+                    entry["path"], entry["expected"], ranges
+                )
+            )
+        else:
+            print("\rInvalid checksum: {}".format(entry["path"]))
+            log.write(
+                "Invalid checksum: {}, expected: {}, got: {}\n".format(
+                    entry["path"], entry["expected"], entry["got"]
+                )
+            )
+
+    def verify_checkpoint_file(self, target):
+        return target["verfile"][: -len(".ver")] + ".vck"
+
+    def load_verify_checkpoint(self, target):
+        # the checkpoint consists of a JSON line with the invalid entries found so far, followed by
+        # the verified files in the format of the verification file
+        verified = {}
+        bad = []
+        checkpoint = self.verify_checkpoint_file(target)
+        if os.path.isfile(checkpoint):
+            with open(checkpoint) as f:
+                bad = json.loads(f.readline())["bad"]
+                for line in f:
+                    md5, path = line.rstrip().split(" ", 1)
+                    verified[path] = md5
+        return verified, bad
+
+    def save_verify_checkpoint(self, target, verified, bad):
+        with atomic_write(self.verify_checkpoint_file(target)) as f:
+            f.write(json.dumps({"bad": bad}) + "\n")
+            for key in verified:
+                f.write("{} {}\n".format(verified[key], key))
+
+    def remove_verify_checkpoint(self, target):
+        if os.path.isfile(self.verify_checkpoint_file(target)):
+            os.remove(self.verify_checkpoint_file(target))
+
+    def verify_abort_reason(self, checked, errors, max_errors=None, max_error_rate=None):
+        if max_errors is not None and errors >= max_errors:
+            return "{} errors".format(errors)
+        if (
+            max_error_rate is not None
+            and checked >= MIN_ERROR_RATE_SAMPLE
+            and errors / checked > max_error_rate
+        ):
+            return "error rate {:.1%} after {} files".format(errors / checked, checked)
+        return None
+
+    @with_target_lock
+    def finish_verification(self, target, timestamp, verified, bad, cancelled, abort_reason):
+        # save what a later verification can use: the chunk digests, the digest cache, and the
+        # checkpoint of a cancelled verification or the time of a completed one
+        if target["chunks_modified"]:
+            self.save_chunks(target)
+        self.digests.save()
+        if cancelled:
+            self.save_verify_checkpoint(target, verified, bad)
+        elif abort_reason is None:
+            self.remove_verify_checkpoint(target)
+            target["last_check"] = timestamp
+            self.save_config(names=[self.target_name(target)], keys=["last_check"])
+
+    def verify_backup(self, target, max_errors=None, max_error_rate=None, resume=False):
         # NB: could also do this with: md5sum --check example.ver
         #     but we want status updates
-        verification_ok = True
+        # max_errors and max_error_rate enable a fail-fast mode (e.g. for a dying disk): the
+        # verification is aborted as soon as either limit is exceeded
+        # with resume, files verified before a cancelled verification are skipped (as long as
+        # their checksum did not change in the meantime)
         t0 = time.time()
         src, dst, verdict = self.prepare_target(target)
+        verified = {}  # path -> MD5 sum of files checked, for the checkpoint
+        bad = []  # structured list of invalid entries
+        if resume:
+            verified, bad = self.load_verify_checkpoint(target)
+            bad = [entry for entry in bad if verdict.get(entry["path"]) == entry["expected"]]
+        verification_ok = not bad
 
         timestamp = datetime.now().strftime("%Y-%m-%d_%H:%M:%S")
+        self.digests.new_run()
 
-        logdir = os.path.join(dst, ".hgbackup", "verification_log")
-        if not os.path.exists(logdir):
-            os.mkdir(logdir)
-        logfile = os.path.join(logdir, os.path.basename(src) + "_" + timestamp + ".log")
-        with open(logfile, "w") as log:
+        logfile, log = self.open_log(dst, "verification_log", src, timestamp)
+        checked = 0
+        skipped = 0
+        io_errors = 0
+        abort_reason = None
+        cancelled = False
+        with log:
             self.new_progress("Verifying backup {}".format(timestamp), len(verdict))
             for key in verdict:
                 self.inc_progress()
                 if verdict[key] == "HL":
                     continue
-                proc = subprocess.Popen(["md5sum", os.path.join(dst, key)], stdout=subprocess.PIPE)
-                md5 = proc.stdout.readline().rstrip().decode("utf-8").split(" ", 1)[0]
-                if not md5 == verdict[key]:
-                    print("\rInvalid checksum: {}".format(key))
-                    log.write(
-                        "Invalid checksum: {}, expected: {}, got: {}\n".format(
-                            key, verdict[key], md5
-                        )
-                    )
-                    verification_ok = False
+                if verified.get(key) == verdict[key]:
+                    skipped += 1
+                    continue
+                if self.cancelled():
+                    cancelled = True
+                    print("\rVerification cancelled, saving checkpoint")
+                    log.write("Verification cancelled after {} files.\n".format(checked))
+                    break
+                checked += 1
+                verified[key] = verdict[key]
+                entry = self.check_file(target, key, fail_fast=max_errors is not None)
+                if entry is None:
+                    continue
+                self.log_bad_entry(log, entry)
+                bad.append(entry)
+                if entry["error"] is not None:
+                    io_errors += 1
+                verification_ok = False
+                abort_reason = self.verify_abort_reason(
+                    checked, len(bad), max_errors, max_error_rate
+                )
+                if abort_reason is not None:
+                    print("\rVerification aborted: {}".format(abort_reason))
+                    log.write("Verification aborted: {}\n".format(abort_reason))
+                    break
             log.write("Verification took {:.1f} seconds.\n".format(time.time() - t0))
             self.done_progress()
 
-        target["last_check"] = timestamp
-        self.save_config()
+        self.finish_verification(target, timestamp, verified, bad, cancelled, abort_reason)
+        # an aborted or cancelled verification does not count as a check
+        verification_ok = verification_ok and not cancelled
+
+        target["report"] = {
+            "entries": len(verdict),
+            "checked": checked,
+            "skipped": skipped,
+            "cancelled": cancelled,
+            "invalid": len(bad),
+            "io_errors": io_errors,
+            "aborted": abort_reason is not None,
+            "abort_reason": abort_reason,
+            "bad": bad,
+            "logfile": logfile,
+            "seconds": time.time() - t0,
+            "ok": verification_ok,
+        }
 
-        if self.thread:
-            self.thread.done_verify.emit()
+        self.emit("done_verify", target["report"])
 
         return verification_ok
 
-    def run_backup(self, target, dry=False, full=False):
+    def stratify_keys(self, dst, keys, deadline=None):
+        # group entries by order of magnitude of their size (powers of 4), so that the few large
+        # files are represented in a sample as well as the many small ones; stops at the deadline
+        strata = {}
+        self.new_progress("Collecting file sizes", len(keys))
+        for key in keys:
+            if self.cancelled() or (deadline is not None and time.time() > deadline):
+                break
+            self.inc_progress()
+            try:
+                size = os.path.getsize(os.path.join(dst, key))
+            except OSError:
+                size = 0  # will be reported as unreadable if sampled
+            strata.setdefault(size.bit_length() // 2, []).append((key, size))
+        self.done_progress()
+        return strata
+
+    def draw_sample(self, strata, sample_size, rng):
+        # proportional allocation with at least one entry per stratum; the result is interleaved
+        # across strata so that a sample cut short by a budget remains stratified
+        population = sum(len(entries) for entries in strata.values())
+        draws = []
+        for stratum, entries in sorted(strata.items()):
+            n = max(1, round(sample_size * len(entries) / population))
+            draws.append(rng.sample(entries, min(n, len(entries))))
+        sample = []
+        for i in range(max([len(d) for d in draws] + [0])):
+            for stratum, d in zip(sorted(strata), draws):
+                if i < len(d):
+                    sample.append((stratum, d[i]))
+        return sample
+
+    def estimate_corruption(self, strata, checked, bad):
+        # stratified estimate of the corruption rate, with Wilson bounds based on the sample size
+        # (the strata of a uniform oversample are proportional to those of all entries)
+        weights = {s: len(strata[s]) for s in checked}
+        total = sum(weights.values())
+        if not total:
+            return 0.0, 0.0, 1.0
+        rate = sum(weights[s] / total * bad.get(s, 0) / checked[s] for s in checked)
+        n = sum(checked.values())
+        lower, upper = wilson_interval(rate * n, n)
+        return rate, lower, upper
+
+    @with_target_lock
+    def sample_verify(
+        self, target, sample_size=1000, time_budget=None, byte_budget=None, seed=None
+    ):
+        # statistical verification of a random, stratified-by-size sample of entries, stopping
+        # early when the time budget (in seconds) is exhausted; files that do not fit into the
+        # remaining byte budget are skipped, smaller ones may still fit
+        t0 = time.time()
         src, dst, verdict = self.prepare_target(target)
+        rng = random.Random(seed)
+        self.digests.new_run()
 
         timestamp = datetime.now().strftime("%Y-%m-%d_%H:%M:%S")
 
+        # the sizes are looked up on dst, which is slow for large targets, hence only for a
+        # uniform oversample of the entries, and within half of the time budget at most
+        keys = [key for key, md5 in verdict.items() if md5 != "HL"]
+        population = len(keys)
+        if population > sample_size * SAMPLE_OVERSAMPLING:
+            keys = rng.sample(keys, sample_size * SAMPLE_OVERSAMPLING)
+        deadline = None if time_budget is None else t0 + time_budget / 2
+        strata = self.stratify_keys(dst, keys, deadline)
+        sample = self.draw_sample(strata, sample_size, rng)
+
+        logfile, log = self.open_log(dst, "verification_log", src, timestamp, "_sample")
+        checked = {}
+        errors = {}
+        bad = []
+        nbytes = 0
+        budget_exhausted = False
+        with log:
+            self.new_progress("Verifying sample {}".format(timestamp), len(sample))
+            for stratum, (key, size) in sample:
+                if self.cancelled():
+                    break
+                if time_budget is not None and time.time() - t0 > time_budget:
+                    budget_exhausted = True
+                    break
+                self.inc_progress()
+                if byte_budget is not None and nbytes + size > byte_budget:
+                    budget_exhausted = True
+                    continue
+                checked[stratum] = checked.get(stratum, 0) + 1
+                nbytes += size
+                entry = self.check_file(target, key)
+                if entry is None:
+                    continue
+                self.log_bad_entry(log, entry)
+                bad.append(entry)
+                errors[stratum] = errors.get(stratum, 0) + 1
+            self.done_progress()
+
+            if target["chunks_modified"]:
+                self.save_chunks(target)
+            self.digests.save()
+
+            rate, lower, upper = self.estimate_corruption(strata, checked, errors)
+            summary = (
+                "Checked {} of {} files ({:.1f} MB), estimated corruption rate: {:.4%} "
+                "(95% confidence: {:.4%} - {:.4%})".format(
+                    sum(checked.values()),
+                    population,
+                    nbytes / 1000.0 / 1000.0,
+                    rate,
+                    lower,
+                    upper,
+                )
+            )
+            print(summary)
+            log.write(summary + "\n")
+            log.write("Verification took {:.1f} seconds.\n".format(time.time() - t0))
+
+        sampled = sum(checked.values())
+        target["report"] = {
+            "population": population,
+            "strata": len(strata),
+            "sampled": sampled,
+            "bytes": nbytes,
+            "budget_exhausted": budget_exhausted,
+            "cancelled": self.cancelled(),
+            "invalid": len(bad),
+            "bad": bad,
+            "estimated_rate": rate,
+            "rate_lower": lower,
+            "rate_upper": upper,
+            "logfile": logfile,
+            "seconds": time.time() - t0,
+            # a sample of nothing (e.g. the budget is too small for any file) proves nothing
+            "ok": not bad and (sampled > 0 or population == 0),
+        }
+
+        self.emit("done_verify", target["report"])
+
+        return target["report"]["ok"]
+
+    def run_process(self, args, on_line):
+        # run a process and feed its output to on_line, line by line; returns the exit code
+        job = current_job.get()
+        if job is not None:
+            return job.run_process(args, on_line)  # cancellable, and driven by the job engine
+        proc = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        for line in proc.stdout:
+            on_line(line.rstrip().decode("utf-8"))
+            if self.cancelled() and proc.poll() is None:
+                proc.terminate()
+        return proc.wait()
+
+    def parse_rsync_line(self, line, verdict, counts, changes=None):
+        if changes is not None and RSYNC_CHANGE.match(line):
+            f = line[line.find("md5:") + 4 + 32 + 1 :]
+            changes.append(f.split(" => ")[0].split(" -> ")[0].rstrip("/"))
+        # detect deleted files
+        if line.startswith("*deleting"):
+            i = line.find("md5:")
+            f = line[i + 4 + 32 + 1 :]
+            verdict.pop(f, None)
+            counts["deleted"] += 1
+        # detect hard links
+        elif line.startswith("hf"):
+            i = line.find("md5:")
+            f = line[i + 4 + 32 + 1 :]
+            j = f.find(" => ")
+            f = f[:j]
+            verdict[f] = "HL"
+            counts["hardlinks"] += 1
+        # detect received files
+        elif line.startswith(">f"):
+            info = line[2 : 2 + 9]
+            i = line.find("md5:")
+            md5 = line[i + 4 : i + 4 + 32]  # extract MD5 sum
+            f = line[i + 4 + 32 + 1 :]  # extract file name
+            counts["received"] += 1
+            if "s" in info or "t" in info or "c" in info:
+                # MD5 sum needs to be updated
+                verdict[f] = md5
+            else:
+                # MD5 sum needs to be added
+                verdict[f] = md5
+
+    def backup_size(self, backupdir):
+        # obtain size of rsync backup folder
+        # NB: Previously we did this with 'du -h -s $backupdir | cut -f 1'
+        # The following method seems to yield a result compatible with Nautilus folder size.
+        # c.f. https://askubuntu.com/a/729725
+        self.new_progress("Obtaining size of rsync backup folder", 1)
+        cmd = "find " + backupdir + " -ls | awk '{sum += $7} END {print sum}'"
+        proc = subprocess.Popen(
+            ["bash", "-c", cmd], stdout=subprocess.PIPE, stderr=subprocess.STDOUT
+        )
+        size = 0
+        while True:
+            line = proc.stdout.readline().rstrip()
+            if not line:
+                break
+            # if awk returns scientific notation (for large ints, c.f. awk -W version), we want to be sure to parse it correctly
+            line = line.decode("utf-8").replace(",", ".")
+            size = int(float(line))
+        print("rsync backup size: {:.1f} GB".format(size / 1000.0 / 1000.0 / 1000.0))
+        self.done_progress()
+        return size
+
+    @with_target_lock
+    def run_backup(
+        self, target, dry=False, full=False, files_from=None, changes=None, timestamp=None
+    ):
+        # files_from restricts the backup to the given paths (relative to the parent of src),
+        # deleting those missing in src from dst; changes collects the paths changed in dst
+
+        # with the change tracker, only the paths that changed since the last backup are
+        # transferred; a full scan is needed after a restart or an overflow of the event queue
+        name = self.target_name(target)
+        tracked = (
+            files_from is None
+            and not dry
+            and self.tracker is not None
+            and self.tracker.tracks(name)
+        )
+        if not tracked:
+            return self.rsync_backup(target, dry, full, files_from, changes, timestamp)
+        taken = self.tracker.take(name)
+        incremental = taken is not None and not full
+        if incremental:
+            files_from = sorted(taken)
+            print("Incremental backup of {} changed paths.".format(len(files_from)))
+        ok = False
+        try:
+            self.rsync_backup(target, dry, full, files_from, changes, timestamp, incremental)
+            ok = target["report"]["ok"]
+        finally:
+            # the taken paths are merged back unless the backup succeeded, also on errors
+            self.tracker.done(name, ok, taken)
+
+    def rsync_backup(self, target, dry, full, files_from, changes, timestamp, incremental=False):
+        t0 = time.time()
+        src, dst, verdict = self.prepare_target(target)
+        counts = {"received": 0, "deleted": 0, "hardlinks": 0}
+
+        if timestamp is None:
+            timestamp = datetime.now().strftime("%Y-%m-%d_%H:%M:%S")
+
         self.new_progress("Running backup {}".format(timestamp), 1)
         rsync = ["rsync"]
         if dry:
@@ -361,15 +1619,13 @@ class HGBCore:
         # --delete = delete extraneous files from dest dirs
 
         # main options
-        rsync.extend(["-avh", "--delete", "--hard-links"])
-        # log options
-        if dry:
-            logdir = os.path.join(dst, ".hgbackup", "rsync_dry_log")
+        if files_from is None:
+            rsync.extend(["-avh", "--delete", "--hard-links"])
         else:
-            logdir = os.path.join(dst, ".hgbackup", "rsync_log")
-        logfile = os.path.join(logdir, os.path.basename(src) + "_" + timestamp + ".log")
-        if not os.path.exists(logdir):
-            os.mkdir(logdir)
+            # NB: -a does not imply -r with --files-from, --force deletes non-empty directories
+            rsync.extend(["-avh", "--delete-missing-args", "--force", "--hard-links"])
+        # log options (rsync's own --log-file would be uncompressed, the output is logged instead)
+        logfile, log = self.open_log(dst, "rsync_dry_log" if dry else "rsync_log", src, timestamp)
         # extract from https://man7.org/linux/man-pages/man5/rsyncd.conf.5.html
         # %C the full-file checksum if it is known for the
         #  file. For older rsync protocols/versions, the
@@ -393,7 +1649,6 @@ class HGBCore:
                 "--itemize-changes",
                 "--checksum-choice=md5",
                 "--stats",
-                "--log-file={}".format(logfile),
             ]
         )
         if not dry:
@@ -404,9 +1659,9 @@ class HGBCore:
         if not os.path.exists(backupdir):
             os.mkdir(backupdir)
         rsync.extend(["--backup", "--suffix=" + backupsuffix, "--backup-dir=" + backupdir])
-        # exclude options
-        excludefile = os.path.join(logdir, os.path.basename(src) + "_" + timestamp + ".exc")
-        with open(excludefile, "w") as f:
+        # exclude options (the exclude and file lists are temporary, they are not kept on dst)
+        with tempfile.NamedTemporaryFile("w", suffix=".exc", delete=False) as f:
+            excludefile = f.name
             for x in target["exclude"]:
                 f.write(x + "\n")
             if not full:
@@ -415,66 +1670,128 @@ class HGBCore:
         rsync.extend(["--exclude-from=" + excludefile])
 
         # src and dst
-        rsync.extend([src, dst])
+        listfile = None
+        if files_from is None:
+            rsync.extend([src, dst])
+        else:
+            with tempfile.NamedTemporaryFile("w", suffix=".lst", delete=False) as f:
+                listfile = f.name
+                for x in files_from:
+                    f.write(x + "\n")
+            rsync.extend(["--files-from=" + listfile, os.path.dirname(src), dst])
 
-        proc = subprocess.Popen(rsync, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-        while True:
-            line = proc.stdout.readline()
-            if not line:
-                break
-            line = line.rstrip().decode("utf-8")
+        changed = changes if changes is not None else []
+
+        def on_line(line):
             print(line)
+            if not RSYNC_PROGRESS.match(line):
+                log.write(line + "\n")
             if not dry:
-                # detect deleted files
-                if line.startswith("*deleting"):
-                    i = line.find("md5:")
-                    f = line[i + 4 + 32 + 1 :]
-                    verdict.pop(f, None)
-                # detect hard links
-                elif line.startswith("hf"):
-                    i = line.find("md5:")
-                    f = line[i + 4 + 32 + 1 :]
-                    j = f.find(" => ")
-                    f = f[:j]
-                    verdict[f] = "HL"
-                # detect received files
-                elif line.startswith(">f"):
-                    info = line[2 : 2 + 9]
-                    i = line.find("md5:")
-                    md5 = line[i + 4 : i + 4 + 32]  # extract MD5 sum
-                    f = line[i + 4 + 32 + 1 :]  # extract file name
-                    if "s" in info or "t" in info or "c" in info:
-                        # MD5 sum needs to be updated
-                        verdict[f] = md5
-                    else:
-                        # MD5 sum needs to be added
-                        verdict[f] = md5
+                self.parse_rsync_line(line, verdict, counts, changed)
+
+        try:
+            with log:
+                log.write(" ".join(rsync) + "\n")
+                returncode = self.run_process(rsync, on_line)
+        finally:
+            os.remove(excludefile)
+            if listfile is not None:
+                os.remove(listfile)
+        cancelled = self.cancelled()
 
         if not dry:
+            # also record the changes of a cancelled backup, they happened nonetheless
+            update_change_index(self.change_index_file(target), timestamp, changed)
+        if not dry and not cancelled:
             target["last_backup"] = timestamp
-        self.save_config()
+        if not dry:
+            self.save_sync_marker(target, timestamp if returncode == 0 and not cancelled else None)
+        self.save_config(names=[self.target_name(target)], keys=["last_backup"])
+        # when cancelled, this keeps the dictionary consistent with the files transferred so far
         self.save_verdict(target)
 
         self.done_progress()
 
-        # obtain size of rsync backup folder
-        # NB: Previously we did this with 'du -h -s $backupdir | cut -f 1'
-        # The following method seems to yield a result compatible with Nautilus folder size.
-        # c.f. https://askubuntu.com/a/729725
-        self.new_progress("Obtaining size of rsync backup folder", 1)
-        cmd = "find " + backupdir + " -ls | awk '{sum += $7} END {print sum}'"
-        proc = subprocess.Popen(
-            ["bash", "-c", cmd], stdout=subprocess.PIPE, stderr=subprocess.STDOUT
-        )
-        while True:
-            line = proc.stdout.readline().rstrip()
-            if not line:
-                break
-            # if awk returns scientific notation (for large ints, c.f. awk -W version), we want to be sure to parse it correctly
-            line = line.decode("utf-8").replace(",", ".")
-            size = int(float(line))
-        print("rsync backup size: {:.1f} GB".format(size / 1000.0 / 1000.0 / 1000.0))
-        self.done_progress()
+        if cancelled:
+            print("Backup cancelled.")
+            size = None
+        else:
+            size = self.backup_size(backupdir)
+
+        target["report"] = {
+            "dry": dry,
+            "full": full,
+            "incremental": incremental,
+            "received": counts["received"],
+            "deleted": counts["deleted"],
+            "hardlinks": counts["hardlinks"],
+            "rsync_returncode": returncode,
+            "logfile": logfile,
+            "backup_size": size,
+            "cancelled": cancelled,
+            "seconds": time.time() - t0,
+            "ok": returncode == 0 and not cancelled,
+        }
+
+        self.emit("done_backup", target["report"])
 
-        if self.thread:
-            self.thread.done_backup.emit()
+    def sync_file(self, target):
+        return target["verfile"][: -len(".ver")] + ".sync"
+
+    def load_sync_marker(self, target):
+        # the timestamp of the last backup to dst that completed without any rsync error, or None
+        try:
+            with open(self.sync_file(target)) as f:
+                return f.read().strip() or None
+        except FileNotFoundError:
+            return None
+
+    def save_sync_marker(self, target, timestamp):
+        # a failed or cancelled backup removes the marker, as dst may contain changes that are
+        # unknown to a later change set
+        if timestamp is None:
+            if os.path.exists(self.sync_file(target)):
+                os.remove(self.sync_file(target))
+            return
+        with atomic_write(self.sync_file(target)) as f:
+            f.write(timestamp + "\n")
+
+    def run_fanout(self, targets, full=False):
+        # back up one src to several dst: the source is scanned only by the backup to the first
+        # connected dst, the resulting change set is then pushed to the other ones with
+        # --files-from, as long as they were in sync with the first one (i.e. the previous backup
+        # was a fan-out as well and completed without errors on both, as recorded by the sync
+        # markers), otherwise they are backed up normally; all backups share the timestamp
+        if len(set(target["src"] for target in targets)) > 1:
+            raise Exception("Fan-out requires targets with the same source")
+        connected = [target for target in targets if target["dst_connected"]]
+        if not connected:
+            raise Exception("None of the destinations is connected")
+        primary = connected[0]
+        last_sync = self.load_sync_marker(primary)
+        timestamp = datetime.now().strftime("%Y-%m-%d_%H:%M:%S")
+
+        changes = []
+        self.run_backup(primary, full=full, changes=changes, timestamp=timestamp)
+        primary["report"]["fanout"] = "primary"
+        reports = [primary["report"]]
+        for target in connected[1:]:
+            if self.cancelled():
+                break
+            in_sync = last_sync is not None and self.load_sync_marker(target) == last_sync
+            if not in_sync or not reports[0]["ok"]:
+                self.run_backup(target, full=full, timestamp=timestamp)
+                target["report"]["fanout"] = "full scan"
+            else:
+                # apply the digests of the first dst, the output of rsync (e.g. for files that
+                # changed since) takes precedence
+                verdict = self.prepare_target(target)[2]
+                for f in changes:
+                    if f in primary["verdict"]:
+                        verdict[f] = primary["verdict"][f]
+                    else:
+                        verdict.pop(f, None)
+                self.run_backup(target, full=full, files_from=changes, timestamp=timestamp)
+                target["report"]["fanout"] = "change set"
+            reports.append(target["report"])
+        return all(report["ok"] for report in reports)
@@ -1,8 +1,5 @@
-import os
-import sys
 import subprocess
-from datetime import datetime
-from io import BytesIO as StringIO
+import threading
 import gi
 
 gi.require_version("Gtk", "3.0")
@@ -17,24 +14,45 @@ from PyQt5.QtWidgets import (
     QMainWindow,
     QWidget,
     QLabel,
-    QTableWidget,
-    QTableWidgetItem,
+    QTableView,
     QHeaderView,
+    QStyle,
+    QStyledItemDelegate,
+    QStyleOptionProgressBar,
+    QApplication,
     QVBoxLayout,
     QHBoxLayout,
     QPushButton,
-    QProgressDialog,
     QTextEdit,
     QMenu,
     QAction,
 )
-from PyQt5.QtCore import Qt, pyqtSignal, pyqtSlot, QThread, QTimer
-from PyQt5.QtGui import QPalette, QFont
+from PyQt5.QtCore import (
+    Qt,
+    pyqtSignal,
+    pyqtSlot,
+    QObject,
+    QTimer,
+    QAbstractTableModel,
+    QModelIndex,
+    QFileSystemWatcher,
+)
+from PyQt5.QtGui import QPalette, QFont, QBrush
+
+from .hgbjobs import HGBJobs
+from .hgbicon import HGBIcons
+from .hgbsched import HGBScheduler
 
-try:
-    from PyQt5.QtCore import QString
-except ImportError:
-    QString = str
+# limits for the fail-fast verification
+FAIL_FAST_MAX_ERRORS = 10
+FAIL_FAST_MAX_ERROR_RATE = 0.01
+# size and time budget (in seconds) of the sampled verification
+SAMPLE_SIZE = 1000
+SAMPLE_TIME_BUDGET = 600
+# interval in seconds at which the connection status of the targets is refreshed
+STATUS_INTERVAL = 1
+# minimum interval in milliseconds between updates of the tray icon
+TRAY_UPDATE_INTERVAL = 500
 
 
 class ReadOnlyConsole(QTextEdit):
@@ -73,39 +91,133 @@ class ReadOnlyConsole(QTextEdit):
         self.data += data.replace("\r", "")
         self.data = self.data[-5000:]
 
+    def set_data(self, data):
+        self.newdata = True
+        self.data = data.replace("\r", "")[-5000:]
+
+
+class JobEvents(QObject):
+    # forwards the events of the job engine (emitted from worker threads) to the GUI thread
+    event = pyqtSignal(object, str, object)
+
+    def __init__(self, jobs, parent=None):
+        super(JobEvents, self).__init__(parent)
+        jobs.subscribe(self.forward)
+
+    def forward(self, job, event, *args):
+        self.event.emit(job, event, args)
+
+
+class StatusCache(QObject):
+    # probes the destinations in a background thread (so that slow or offline mounts do not block
+    # the GUI), and only reports the targets whose connection status changed
+    changed = pyqtSignal(str, bool)
+
+    def __init__(self, hgbcore, parent=None):
+        super(StatusCache, self).__init__(parent)
+        self.hgbcore = hgbcore
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.loop, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def loop(self):
+        while not self.stopped.wait(STATUS_INTERVAL):
+            # the thread must survive errors (e.g. the configuration being reloaded meanwhile)
+            try:
+                connections = self.hgbcore.update_connections()
+            except Exception as e:
+                print("Cannot update the connection status: {}".format(e))
+                continue
+            for name, (status, toggle) in connections.items():
+                if toggle:
+                    self.changed.emit(name, status)
+
+    def stop(self):
+        self.stopped.set()
 
-class WorkerThread(QThread):
-    new_console_data = pyqtSignal(QString)
-    new_progress = pyqtSignal(str, int)
-    set_progress = pyqtSignal(int)
-    done_progress = pyqtSignal()
-    done_backup = pyqtSignal()
-    done_verify = pyqtSignal()
-    fn = None
-    args = None
-    kwargs = None
 
-    def __init__(self, console, parent=None):
-        super(WorkerThread, self).__init__(parent)
-        # set up console
-        self.console = console
-        self.new_console_data[QString].connect(self.console.write)
+class TargetModel(QAbstractTableModel):
+    # the targets and the progress of their jobs, read from the core when a row is displayed, so
+    # that only the rows that changed need to be updated
+    columns = ["name", "src", "dst", "connected", "last_backup", "last_check", "job"]
 
-    def execute(self, fn, *args, **kwargs):
-        self.fn = fn
-        self.args = args
-        self.kwargs = kwargs
-        self.start()
+    def __init__(self, hgbcore, parent=None):
+        super(TargetModel, self).__init__(parent)
+        self.hgbcore = hgbcore
+        self.names = list(hgbcore.config["targets"])
+        self.rows = {name: row for row, name in enumerate(self.names)}
+        self.jobs = {}  # target name -> (label, percentage or None if unknown)
+
+    def reload(self):
+        # after the configuration was reloaded
+        self.beginResetModel()
+        self.names = list(self.hgbcore.config["targets"])
+        self.rows = {name: row for row, name in enumerate(self.names)}
+        self.endResetModel()
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.names)
+
+    def columnCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.columns)
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if orientation == Qt.Horizontal and role == Qt.DisplayRole:
+            return self.columns[section]
+        return None
+
+    def data(self, index, role=Qt.DisplayRole):
+        name = self.names[index.row()]
+        target = self.hgbcore.config["targets"].get(name)
+        column = self.columns[index.column()]
+        if target is None:
+            return None
+        if column == "connected":
+            if role == Qt.DisplayRole:
+                return "ready" if target["dst_connected"] else "N/A"
+            if role == Qt.BackgroundRole:
+                return QBrush(Qt.green if target["dst_connected"] else Qt.red)
+        elif column == "job":
+            job = self.jobs.get(name)
+            if job is not None and role == Qt.DisplayRole:
+                return job[0]
+            if job is not None and role == Qt.UserRole:
+                return job[1]
+        elif role == Qt.DisplayRole:
+            return name if column == "name" else target[column]
+        return None
+
+    def update_row(self, name):
+        row = self.rows.get(name)
+        if row is not None:
+            self.dataChanged.emit(self.index(row, 0), self.index(row, len(self.columns) - 1))
+
+    def set_job(self, name, label, percentage=None):
+        if label is None:
+            self.jobs.pop(name, None)
+        else:
+            self.jobs[name] = (label, percentage)
+        self.update_row(name)
 
-    def run(self):
-        std_sav = sys.stdout, sys.stderr
-        sys.stdout = sys.stderr = sio = StringIO()
-        sio.write = self.new_console_data.emit
 
-        self.fn(*self.args, **self.kwargs)
+class ProgressDelegate(QStyledItemDelegate):
+    # draws the job column as a progress bar (busy indicator if the percentage is unknown)
 
-        sys.stdout, sys.stderr = std_sav
-        sio.close()
+    def paint(self, painter, option, index):
+        label = index.data(Qt.DisplayRole)
+        if label is None:
+            return super(ProgressDelegate, self).paint(painter, option, index)
+        percentage = index.data(Qt.UserRole)
+        bar = QStyleOptionProgressBar()
+        bar.rect = option.rect
+        bar.minimum = 0
+        bar.maximum = 0 if percentage is None else 100
+        bar.progress = percentage or 0
+        bar.text = label
+        bar.textVisible = True
+        QApplication.style().drawControl(QStyle.CE_ProgressBar, bar, painter)
 
 
 class HGBGUI(QMainWindow):
@@ -120,18 +232,18 @@ class HGBGUI(QMainWindow):
         self.setGeometry(100, 100, 1024, 768)
 
         # set up table for targets
-        self.table = QTableWidget()
-        self.table.setEditTriggers(QTableWidget.NoEditTriggers)
-        self.table.setSelectionBehavior(QTableWidget.SelectRows)
-        self.table.setSelectionMode(QTableWidget.SingleSelection)
-        self.table.setRowCount(len(self.hgbcore.config["targets"]))
-        self.table.setColumnCount(6)
+        self.model = TargetModel(self.hgbcore, parent=self)
+        self.table = QTableView()
+        self.table.setModel(self.model)
+        self.table.setEditTriggers(QTableView.NoEditTriggers)
+        self.table.setSelectionBehavior(QTableView.SelectRows)
+        self.table.setSelectionMode(QTableView.SingleSelection)
         self.table.verticalHeader().hide()
-        self.table.setHorizontalHeaderLabels(
-            ["name", "src", "dst", "connected", "last_backup", "last_check"]
-        )
         self.table.horizontalHeader().setSectionResizeMode(QHeaderView.Stretch)
-        self.table.currentCellChanged.connect(self.onCellChanged)
+        self.table.setItemDelegateForColumn(
+            TargetModel.columns.index("job"), ProgressDelegate(self.table)
+        )
+        self.table.selectionModel().currentRowChanged.connect(self.onCurrentRowChanged)
 
         # set up buttons
         self.btnBackup = QPushButton("Backup")
@@ -140,39 +252,47 @@ class HGBGUI(QMainWindow):
         self.menuBackup.addAction("Backup (full)", self.runfull_backup)
         self.menuBackup.addAction("Dry run", self.dryrun_backup)
         self.menuBackup.addAction("Dry run (full)", self.dryrunfull_backup)
+        self.menuBackup.addAction("Backup all destinations of this source", self.fanout_backup)
         self.btnBackup.setMenu(self.menuBackup)
         self.btnCheck = QPushButton("Check verification dictionary")
         self.btnCheck.clicked.connect(self.check_backup)
         self.btnRepair = QPushButton("Repair verification dictionary")
         self.btnRepair.clicked.connect(self.repair_verdict)
         self.btnVerify = QPushButton("Verify")
-        self.btnVerify.clicked.connect(self.verify_backup)
+        self.menuVerify = QMenu()
+        self.menuVerify.addAction("Verify", self.verify_backup)
+        self.menuVerify.addAction("Verify (fail fast)", self.failfast_verify_backup)
+        self.menuVerify.addAction("Verify (sample)", self.sample_verify_backup)
+        self.menuVerify.addAction("Resume cancelled verification", self.resume_verify_backup)
+        self.btnVerify.setMenu(self.menuVerify)
+        self.btnCancel = QPushButton("Cancel")
+        self.btnCancel.clicked.connect(self.cancel_job)
         self.btnConfig = QPushButton("Open configuration file")
         self.btnConfig.clicked.connect(self.open_config_file)
         # disable these buttons on startup (in case no targets are defined)
-        for btn in [self.btnBackup, self.btnCheck, self.btnRepair, self.btnVerify]:
+        for btn in [self.btnBackup, self.btnCheck, self.btnRepair, self.btnVerify, self.btnCancel]:
             btn.setEnabled(False)
 
-        # set up console and worker thread
+        # set up console and job engine (each target can run one job at a time, but jobs for
+        # different targets run concurrently)
         self.readonlyconsole = ReadOnlyConsole()
-        self.wt = WorkerThread(self.readonlyconsole, parent=self)
-        self.hgbcore.thread = self.wt
-        self.wt.done_backup.connect(self.done_backup)
-        self.wt.done_verify.connect(self.done_verify)
-        # make sure that signals from the worker thread are dealt with consecutively
-        # (e.g. that the set_progress_handler for 100% and the done_progress_handler
-        # are not executed simultaneously, which can lead to undesired behaviour)
-        # c.f. https://doc.qt.io/qt-5/threads-qobject.html
-        # and  https://www.riverbankcomputing.com/static/Docs/PyQt5/signals_slots.html
-        t = Qt.BlockingQueuedConnection
-        # make connections
-        self.wt.new_progress.connect(self.new_progress_handler, type=t)
-        self.wt.set_progress.connect(self.set_progress_handler, type=t)
-        self.wt.done_progress.connect(self.done_progress_handler, type=t)
+        self.jobs = HGBJobs()
+        self.target_jobs = {}  # target name -> job
+        self.jobevents = JobEvents(self.jobs, parent=self)
+        self.jobevents.event.connect(self.job_event_handler)
+        # the scheduler runs due backups and verifications by itself
+        self.scheduler = HGBScheduler(self.hgbcore, self.jobs)
 
         # set up layout
         l2 = QHBoxLayout()
-        for w in [self.btnBackup, self.btnCheck, self.btnRepair, self.btnVerify, self.btnConfig]:
+        for w in [
+            self.btnBackup,
+            self.btnCheck,
+            self.btnRepair,
+            self.btnVerify,
+            self.btnCancel,
+            self.btnConfig,
+        ]:
             l2.addWidget(w)
         l = QVBoxLayout()
         l.addWidget(self.table)
@@ -182,32 +302,23 @@ class HGBGUI(QMainWindow):
         cw.setLayout(l)
         self.setCentralWidget(cw)
 
-        # populate table with targets
-        for i, (name, target) in enumerate(self.hgbcore.config["targets"].items()):
-            self.table.setItem(i, 0, QTableWidgetItem(name))
-            self.table.setItem(i, 1, QTableWidgetItem(target["src"]))
-            self.table.setItem(i, 2, QTableWidgetItem(target["dst"]))
-            self.table.setItem(i, 3, QTableWidgetItem(""))
-            self.table.setItem(i, 4, QTableWidgetItem(target["last_backup"]))
-            self.table.setItem(i, 5, QTableWidgetItem(target["last_check"]))
-            self.table.selectRow(0)
-            self.update_target_connection(i, name, target)
-
-        # set up target watcher
-        self.timer = QTimer()
-        self.timer.setInterval(1000)
-        self.timer.timeout.connect(self.folder_watcher)
-        self.timer.start()
+        self.table.selectRow(0)
 
-        # set up periodicity watcher
-        self.timer2 = QTimer()
-        self.timer2.setInterval(10000)
-        self.timer2.timeout.connect(self.periodicity_watcher)
-        self.timer2.start()
+        # set up target watcher (the connections were probed when the configuration was loaded)
+        self.status = StatusCache(self.hgbcore, parent=self)
+        self.status.changed.connect(self.connection_changed)
+        self.status.start()
+
+        # reload the configuration when it is modified (e.g. by the command line tool)
+        self.config_watcher = QFileSystemWatcher([self.hgbcore.config_file], self)
+        self.config_watcher.fileChanged.connect(self.config_changed)
 
         # set up notifications
         Notify.init("HGBackup")
 
+        self.scheduler.start()
+        self.hgbcore.start_tracker()
+
         # set up app indicator
         self.ind = AppIndicator.Indicator.new(
             "indicator-autosync", "task-due", AppIndicator.IndicatorCategory.SYSTEM_SERVICES
@@ -216,6 +327,17 @@ class HGBGUI(QMainWindow):
         # need to set this for indicator to be shown
         self.ind.set_status(AppIndicator.IndicatorStatus.ACTIVE)
 
+        # progress icons are rendered when needed, and the icon is updated at a limited rate: the
+        # handlers only record the progress, the timer renders and shows the icon for it
+        self.icons = HGBIcons()
+        self.ind.set_icon_theme_path(self.icons.path)
+        self.tray_progress = None  # None if idle, percentage or "unknown" otherwise
+        self.tray_icon_shown = "task-due"
+        self.tray_timer = QTimer()
+        self.tray_timer.setInterval(TRAY_UPDATE_INTERVAL)
+        self.tray_timer.timeout.connect(self.update_tray_icon)
+        self.tray_timer.start()
+
         # have to give indicator a menu
         self.menu = Gtk.Menu()
 
@@ -235,41 +357,94 @@ class HGBGUI(QMainWindow):
         self.menu.show()
         self.ind.set_menu(self.menu)
 
-    def new_progress_handler(self, label, length):
-        # set up progress dialog
-        self.progress = QProgressDialog(self)
-        self.progress.setWindowModality(Qt.WindowModal)
-        self.progress.setWindowTitle("Working...")
-        self.progress.setLabelText(label + "...")
-        self.progress.setMinimumDuration(0)
-        self.progress.setAutoReset(False)
-        # as long as cancelling is not implemented, remove the close button and the cancel button
-        self.progress.setWindowFlags(Qt.Dialog | Qt.WindowTitleHint | Qt.CustomizeWindowHint)
-        self.progress.setCancelButton(None)
-        self.progress.reset()  # kill the initial 4 second timer (c.f. https://doc.qt.io/qt-5/qprogressdialog.html)
+    def job_event_handler(self, job, event, args):
+        if event == "started" and job.name not in self.target_jobs:
+            # started by the scheduler
+            self.target_jobs[job.name] = job
+            Notify.Notification.new(
+                "HGBackup is running a scheduled job for target {}.".format(job.name)
+            ).show()
+            self.update_buttons()
+        elif event == "output":
+            if job.name == self.get_current_target_name():
+                self.readonlyconsole.write(args[0])
+        elif event == "new_progress":
+            self.new_progress_handler(job, *args)
+        elif event == "set_progress":
+            self.set_progress_handler(job, *args)
+        elif event == "done_progress":
+            self.done_progress_handler(job)
+        elif event == "done_backup":
+            self.done_backup(job.name)
+        elif event == "done_verify":
+            self.done_verify(job.name, *args)
+        elif event == "finished":
+            self.done_job(job, *args)
+
+    def job_targets(self, job):
+        # a fan-out job runs for several targets
+        return [name for name, j in self.target_jobs.items() if j is job] or [job.name]
+
+    def update_tray_icon(self):
+        if self.tray_progress is None:
+            icon = "task-due"
+        elif self.tray_progress == "unknown":
+            icon = self.icons.unknown()
+        else:
+            icon = self.icons.pie(self.tray_progress)
+        if icon != self.tray_icon_shown:
+            self.ind.set_icon_full(icon, "HGBackup")
+            self.tray_icon_shown = icon
 
+    def new_progress_handler(self, job, label, length):
         if length == 1:  # only one element
-            self.progress.setMaximum(0)
-            self.ind.set_icon(os.path.join(os.path.dirname(__file__), "pie", "unknown.png"))
+            percentage = None
+            self.tray_progress = "unknown"
         else:
-            self.progress.setMaximum(100)
-            self.ind.set_icon(os.path.join(os.path.dirname(__file__), "pie", "0.png"))
-        self.progress.setValue(0)
+            percentage = 0
+            self.tray_progress = 0
+        for name in self.job_targets(job):
+            self.model.set_job(name, label, percentage)
 
-    def set_progress_handler(self, value):
+    def set_progress_handler(self, job, value):
         if value not in range(101):
             raise Exception("Invalid progress value")
-        self.progress.setValue(value)
-        self.ind.set_icon(os.path.join(os.path.dirname(__file__), "pie", "{}.png".format(value)))
+        label = "{} ({}%, {})".format(job.label, value, job.rate())
+        for name in self.job_targets(job):
+            self.model.set_job(name, label, value)
+        self.tray_progress = value
+
+    def done_progress_handler(self, job):
+        for name in self.job_targets(job):
+            self.model.set_job(name, job.label, 100)
+        self.tray_progress = None
+
+    def done_job(self, job, state):
+        for name in self.job_targets(job):
+            self.model.set_job(name, None)
+            self.target_jobs.pop(name, None)
+        if state == "failed":
+            job.write("\nERROR: {}\n".format(job.error))
+            Notify.Notification.new("HGBackup job for target {} failed.".format(job.name)).show()
+        elif state == "cancelled":
+            job.write("\nCancelled.\n")
+        self.update_buttons()
 
-    def done_progress_handler(self):
-        self.progress.reset()
-        self.ind.set_icon("task-due")
+    def cancel_job(self):
+        job = self.target_jobs.get(self.get_current_target_name())
+        if job is not None:
+            job.cancel()
 
     def closeEvent(self, evt):
         if not self.quit:
             self.hide()
             evt.ignore()
+        else:
+            self.status.stop()
+            self.scheduler.stop()
+            self.jobs.shutdown()
+            self.hgbcore.stop_tracker()
+            self.icons.cleanup()
 
     def handler_menu_show(self, evt):
         self.setWindowFlags(self.windowFlags() ^ Qt.WindowStaysOnTopHint)
@@ -283,99 +458,130 @@ class HGBGUI(QMainWindow):
         self.quit = True
         self.close()
 
-    def onCellChanged(self, currentRow, currentColumn, previousRow, previousColumn):
+    def config_changed(self, path):
+        # the file is replaced when it is saved, which ends the watch
+        if path not in self.config_watcher.files():
+            self.config_watcher.addPath(path)
+        name = self.get_current_target_name()
+        if not self.hgbcore.reload_config():
+            return  # saved by this process
+        self.model.reload()
+        row = self.model.rows.get(name, 0)
+        self.table.selectRow(row)
+        self.scheduler.reschedule()
+        self.update_buttons()
+
+    def onCurrentRowChanged(self, current, previous):
         self.update_buttons()
+        # show the output of the selected target's job
+        job = self.target_jobs.get(self.get_current_target_name())
+        self.readonlyconsole.set_data(job.output if job is not None else "")
+
+    def get_current_target_name(self):
+        row = self.table.currentIndex().row()
+        return self.model.names[row] if row >= 0 else None
 
     def get_current_target(self):
-        targetname = self.table.item(self.table.currentRow(), 0).text()
-        return self.hgbcore.config["targets"][targetname]
+        return self.hgbcore.config["targets"][self.get_current_target_name()]
+
+    def execute(self, fn, **kwargs):
+        name = self.get_current_target_name()
+        if name in self.target_jobs:
+            return  # one job per target at a time
+        self.readonlyconsole.set_data("")
+        self.target_jobs[name] = self.jobs.submit(name, fn, self.get_current_target(), **kwargs)
+        self.update_buttons()
 
     def run_backup(self):
-        self.wt.execute(self.hgbcore.run_backup, self.get_current_target())
+        self.execute(self.hgbcore.run_backup)
 
     def dryrun_backup(self):
-        self.wt.execute(self.hgbcore.run_backup, self.get_current_target(), dry=True)
+        self.execute(self.hgbcore.run_backup, dry=True)
 
     def runfull_backup(self):
-        self.wt.execute(self.hgbcore.run_backup, self.get_current_target(), full=True)
+        self.execute(self.hgbcore.run_backup, full=True)
 
     def dryrunfull_backup(self):
-        self.wt.execute(self.hgbcore.run_backup, self.get_current_target(), dry=True, full=True)
-
-    def done_backup(self):
-        self.table.item(self.table.currentRow(), 4).setText(
-            self.get_current_target()["last_backup"]
+        self.execute(self.hgbcore.run_backup, dry=True, full=True)
+
+    def fanout_backup(self):
+        src = self.get_current_target()["src"]
+        names = [
+            name
+            for name, target in self.hgbcore.config["targets"].items()
+            if target["src"] == src and target["dst_connected"]
+        ]
+        if any(name in self.target_jobs for name in names):
+            return
+        self.readonlyconsole.set_data("")
+        job = self.jobs.submit(
+            self.get_current_target_name(),
+            self.hgbcore.run_fanout,
+            [self.hgbcore.config["targets"][name] for name in names],
         )
+        for name in names:
+            self.target_jobs[name] = job
+        self.update_buttons()
+
+    def done_backup(self, targetname):
+        # NB: a fan-out job backs up several targets
+        src = self.hgbcore.config["targets"][targetname]["src"]
+        for name, target in self.hgbcore.config["targets"].items():
+            if target["src"] == src:
+                self.model.update_row(name)
 
     def check_backup(self):
-        self.wt.execute(self.hgbcore.check_verdict, self.get_current_target())
+        self.execute(self.hgbcore.check_verdict)
 
     def repair_verdict(self):
-        self.wt.execute(self.hgbcore.check_verdict, self.get_current_target(), repair=True)
+        self.execute(self.hgbcore.check_verdict, repair=True)
 
     def verify_backup(self):
-        self.wt.execute(self.hgbcore.verify_backup, self.get_current_target())
+        self.execute(self.hgbcore.verify_backup)
+
+    def failfast_verify_backup(self):
+        self.execute(
+            self.hgbcore.verify_backup,
+            max_errors=FAIL_FAST_MAX_ERRORS,
+            max_error_rate=FAIL_FAST_MAX_ERROR_RATE,
+        )
+
+    def resume_verify_backup(self):
+        self.execute(self.hgbcore.verify_backup, resume=True)
+
+    def sample_verify_backup(self):
+        self.execute(
+            self.hgbcore.sample_verify, sample_size=SAMPLE_SIZE, time_budget=SAMPLE_TIME_BUDGET
+        )
 
-    def done_verify(self):
-        self.table.item(self.table.currentRow(), 5).setText(self.get_current_target()["last_check"])
+    def done_verify(self, targetname, report):
+        self.model.update_row(targetname)
+        if not report["ok"]:
+            Notify.Notification.new(
+                "HGBackup verification of target {} {}: {} invalid file(s).".format(
+                    targetname, "aborted" if report.get("aborted") else "failed", len(report["bad"])
+                )
+            ).show()
 
     def update_buttons(self):
+        name = self.get_current_target_name()
+        if name is None:
+            return
         target = self.get_current_target()
-        enable = False
-        if target["dst_connected"]:
-            enable = True
+        enable = target["dst_connected"] and name not in self.target_jobs
         for btn in [self.btnBackup, self.btnCheck, self.btnRepair, self.btnVerify]:
             btn.setEnabled(enable)
+        self.btnCancel.setEnabled(name in self.target_jobs)
 
-    def update_target_connection(self, i, name, target):
-        status, toggle = self.hgbcore.update_target_connection(target)
+    def connection_changed(self, name, status):
+        self.model.update_row(name)
+        if name == self.get_current_target_name():
+            self.update_buttons()
         if status:
-            self.table.item(i, 3).setText("ready")
-            self.table.item(i, 3).setBackground(Qt.green)
-        else:
-            self.table.item(i, 3).setText("N/A")
-            self.table.item(i, 3).setBackground(Qt.red)
-        self.update_buttons()
-        return status, toggle
-
-    def folder_watcher(self):
-        for i, (name, target) in enumerate(self.hgbcore.config["targets"].items()):
-            status, toggle = self.update_target_connection(i, name, target)
-            if not toggle:  # status did not change
-                continue
-            Notify.Notification.new(
-                "HGBackup target {} {}connected.".format(name, "" if status else "dis")
-            ).show()
-
-    def periodicity_watcher(self):
-        for i, (name, target) in enumerate(self.hgbcore.config["targets"].items()):
-            if target["per_backup"] is not None and target["last_backup"] is not None:
-                last_backup = datetime.strptime(target["last_backup"], "%Y-%m-%d_%H:%M:%S")
-                days = (datetime.now() - last_backup).days
-                notified = (
-                    "notified_backup" in target
-                    and target["notified_backup"] == datetime.now().date()
-                )
-                if days > target["per_backup"] and not notified:
-                    Notify.Notification.new(
-                        "HGBackup target {} has to be backed up. Last back up {} days ago.".format(
-                            name, days
-                        )
-                    ).show()
-                    target["notified_backup"] = datetime.now().date()
-            if target["per_check"] is not None and target["last_check"] is not None:
-                last_check = datetime.strptime(target["last_check"], "%Y-%m-%d_%H:%M:%S")
-                days = (datetime.now() - last_check).days
-                notified = (
-                    "notified_check" in target and target["notified_check"] == datetime.now().date()
-                )
-                if days > target["per_check"] and not notified:
-                    Notify.Notification.new(
-                        "HGBackup target {} has to be verified. Last verification {} days ago.".format(
-                            name, days
-                        )
-                    ).show()
-                    target["notified_check"] = datetime.now().date()
+            self.scheduler.notify()
+        Notify.Notification.new(
+            "HGBackup target {} {}connected.".format(name, "" if status else "dis")
+        ).show()
 
     def open_config_file(self):
         subprocess.call(["code", self.hgbcore.config_file])
@@ -0,0 +1,108 @@
+import os
+import math
+import zlib
+import struct
+import tempfile
+
+FG = (0xCC, 0xCC, 0xCC)
+BG = (0x33, 0x33, 0x33)
+ICON_SIZE = 64
+# subsamples per pixel and axis, for anti-aliasing
+SUPERSAMPLING = 3
+
+
+def png(size, pixels):
+    # encode rows of RGBA tuples as PNG (c.f. https://www.w3.org/TR/png/)
+    def chunk(kind, data):
+        return (
+            struct.pack(">I", len(data))
+            + kind
+            + data
+            + struct.pack(">I", zlib.crc32(kind + data) & 0xFFFFFFFF)
+        )
+
+    raw = b"".join(b"\0" + bytes(c for pixel in row for c in pixel) for row in pixels)
+    return (
+        b"\x89PNG\r\n\x1a\n"
+        + chunk(b"IHDR", struct.pack(">IIBBBBB", size, size, 8, 6, 0, 0, 0))
+        + chunk(b"IDAT", zlib.compress(raw, 9))
+        + chunk(b"IEND", b"")
+    )
+
+
+def render(size, color_at):
+    # color_at(x, y) returns the color at a point of the unit square centered at (0, 0), or None
+    # where the icon is transparent
+    n = SUPERSAMPLING
+    pixels = []
+    for row in range(size):
+        line = []
+        for col in range(size):
+            samples = []
+            for i in range(n):
+                for j in range(n):
+                    x = (col + (j + 0.5) / n) / size - 0.5
+                    y = 0.5 - (row + (i + 0.5) / n) / size
+                    color = color_at(x, y)
+                    if color is not None:
+                        samples.append(color)
+            if not samples:
+                line.append((0, 0, 0, 0))
+                continue
+            line.append(
+                tuple(sum(s[k] for s in samples) // len(samples) for k in range(3))
+                + (255 * len(samples) // (n * n),)
+            )
+        pixels.append(line)
+    return png(size, pixels)
+
+
+def render_pie(percentage, size=ICON_SIZE):
+    # the foreground grows clockwise from the top, like a clock
+    def color_at(x, y):
+        if x * x + y * y > 0.25:
+            return None
+        angle = math.degrees(math.atan2(x, y)) % 360
+        return FG if angle < percentage * 3.6 else BG
+
+    return render(size, color_at)
+
+
+def render_unknown(size=ICON_SIZE):
+    # a pie with three dots, for progress of unknown length
+    def color_at(x, y):
+        if x * x + y * y > 0.25:
+            return None
+        if abs(y) < 0.0625 and any(abs(x - cx) < 0.0625 for cx in [-0.2, 0.0, 0.2]):
+            return FG
+        return BG
+
+    return render(size, color_at)
+
+
+class HGBIcons:
+    # renders the progress icons of the tray on first use, and writes them to a runtime folder
+    # (usually in RAM) since the app indicator loads icons by name
+
+    def __init__(self):
+        base = os.environ.get("XDG_RUNTIME_DIR") or tempfile.gettempdir()
+        self.path = tempfile.mkdtemp(prefix="hgbackup-icons-", dir=base)
+        self.icons = set()  # names of the icons written so far
+
+    def get(self, name, render_fn, *args):
+        if name not in self.icons:
+            with open(os.path.join(self.path, name + ".png"), "wb") as f:
+                f.write(render_fn(*args))
+            self.icons.add(name)
+        return name
+
+    def pie(self, percentage):
+        return self.get("hgbackup-pie-{}".format(percentage), render_pie, percentage)
+
+    def unknown(self):
+        return self.get("hgbackup-pie-unknown", render_unknown)
+
+    def cleanup(self):
+        for name in self.icons:
+            os.remove(os.path.join(self.path, name + ".png"))
+        os.rmdir(self.path)
@@ -0,0 +1,228 @@
+import sys
+import time
+import queue
+import asyncio
+import threading
+import itertools
+import contextvars
+import subprocess
+import concurrent.futures
+
+# the job whose function is executed in the current thread (or asyncio task), if any
+current_job = contextvars.ContextVar("current_job", default=None)
+
+# interval in seconds at which running processes check for cancellation
+CANCEL_POLL_INTERVAL = 0.2
+# number of characters of output kept per job
+OUTPUT_BUFFER_SIZE = 5000
+
+
+def format_rate(i, length, elapsed):
+    # throughput and estimated remaining time of a progress
+    if not i or not elapsed:
+        return ""
+    rate = i / elapsed
+    remaining = int((length - i) / rate)
+    return "{:.1f}/s, {}:{:02d}:{:02d} left".format(
+        rate, remaining // 3600, remaining // 60 % 60, remaining % 60
+    )
+
+
+class JobOutput:
+    # replaces sys.stdout and sys.stderr once, and forwards output to the current job, so that the
+    # output of concurrent jobs does not interleave (and the streams need not be swapped per job)
+
+    def __init__(self, stream):
+        self.stream = stream
+
+    def write(self, data):
+        job = current_job.get()
+        if job is None:
+            return self.stream.write(data)
+        job.write(data)
+        return len(data)
+
+    def flush(self):
+        if current_job.get() is None:
+            self.stream.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+class Job:
+    ids = itertools.count(1)
+
+    def __init__(self, engine, name, fn, args, kwargs):
+        self.id = next(self.ids)
+        self.engine = engine
+        self.name = name
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.state = "pending"
+        self.result = None
+        self.error = None
+        self.output = ""
+        self.cancelled = threading.Event()  # cancellation token
+        self.future = None
+        self.label = None
+        self.i = 0
+        self.length = 0
+        self.percentage = 0
+        self.progress_started = None
+
+    def emit(self, event, *args):
+        self.engine.emit(self, event, *args)
+
+    def write(self, data):
+        self.output = (self.output + data)[-OUTPUT_BUFFER_SIZE:]
+        self.emit("output", data)
+
+    def cancel(self):
+        if not self.cancelled.is_set():
+            self.cancelled.set()
+            self.emit("cancel")
+
+    def wait(self, timeout=None):
+        # returns the result of the job function, or raises its exception
+        return self.future.result(timeout)
+
+    def new_progress(self, label, length):
+        self.label = label
+        self.i = 0
+        self.percentage = 0
+        self.length = length
+        self.progress_started = time.time()
+        self.emit("new_progress", label, length)
+
+    def inc_progress(self):
+        self.i += 1
+        if self.i / self.length * 100 >= self.percentage + 1:
+            self.percentage = int(self.i / self.length * 100)
+            self.emit("set_progress", self.percentage)
+
+    def done_progress(self):
+        self.emit("done_progress")
+
+    def rate(self):
+        # computed by the subscribers when they display the progress, not by the job
+        return format_rate(self.i, self.length, time.time() - self.progress_started)
+
+    def run_process(self, args, on_line):
+        # run a process on the engine's event loop, which only reads its output, and feed it line
+        # by line to on_line in this job's thread, so that a slow consumer (e.g. writing a log on
+        # dst) does not hold up the other jobs; returns the exit code
+        lines = queue.Queue()
+        future = asyncio.run_coroutine_threadsafe(
+            self.run_process_async(args, lines), self.engine.loop
+        )
+        future.add_done_callback(lambda f: lines.put(None))  # after the last line
+        try:
+            while True:
+                line = lines.get()
+                if line is None:
+                    break
+                on_line(line)
+        except BaseException:
+            future.cancel()  # kills the process
+            raise
+        return future.result()
+
+    async def run_process_async(self, args, lines):
+        proc = await asyncio.create_subprocess_exec(
+            *args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT
+        )
+
+        async def watch_cancel():
+            while not self.cancelled.is_set():
+                await asyncio.sleep(CANCEL_POLL_INTERVAL)
+            proc.terminate()
+
+        watcher = asyncio.ensure_future(watch_cancel())
+        try:
+            while True:
+                line = await proc.stdout.readline()
+                if not line:
+                    break
+                lines.put(line.rstrip().decode("utf-8"))
+        except BaseException:
+            proc.kill()
+            raise
+        finally:
+            watcher.cancel()
+            returncode = await proc.wait()
+        return returncode
+
+
+class HGBJobs:
+    # runs core functions as jobs: each job gets its own output stream, cancellation token and
+    # progress events, and several jobs can run concurrently; subscribers receive all events
+    # as callback(job, event, *args), from the thread the event originated in
+
+    def __init__(self, max_workers=None):
+        self.loop = asyncio.new_event_loop()
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers)
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+        self.jobs = {}
+        self.subscribers = []
+        self.lock = threading.Lock()
+        if not isinstance(sys.stdout, JobOutput):
+            sys.stdout = JobOutput(sys.stdout)
+        if not isinstance(sys.stderr, JobOutput):
+            sys.stderr = JobOutput(sys.stderr)
+
+    def subscribe(self, callback):
+        self.subscribers.append(callback)
+
+    def unsubscribe(self, callback):
+        self.subscribers.remove(callback)
+
+    def emit(self, job, event, *args):
+        for callback in list(self.subscribers):
+            callback(job, event, *args)
+
+    def submit(self, name, fn, *args, **kwargs):
+        job = Job(self, name, fn, args, kwargs)
+        with self.lock:
+            self.jobs[job.id] = job
+        job.future = asyncio.run_coroutine_threadsafe(self.run(job), self.loop)
+        return job
+
+    def active_jobs(self):
+        with self.lock:
+            return [job for job in self.jobs.values() if job.state in ["pending", "running"]]
+
+    async def run(self, job):
+        context = contextvars.copy_context()
+        context.run(current_job.set, job)
+        job.state = "running"
+        job.emit("started")
+        try:
+            job.result = await self.loop.run_in_executor(
+                self.executor, lambda: context.run(job.fn, *job.args, **job.kwargs)
+            )
+            job.state = "cancelled" if job.cancelled.is_set() else "done"
+            return job.result
+        except Exception as e:
+            job.error = e
+            job.state = "cancelled" if job.cancelled.is_set() else "failed"
+            raise
+        finally:
+            with self.lock:
+                del self.jobs[job.id]
+            job.emit("finished", job.state)
+
+    def shutdown(self, cancel=True):
+        jobs = self.active_jobs()
+        for job in jobs:
+            if cancel:
+                job.cancel()
+            try:
+                job.wait()
+            except Exception:
+                pass  # reported through the job's "finished" event
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.executor.shutdown(wait=True)
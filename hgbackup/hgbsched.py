@@ -0,0 +1,202 @@
+import os
+import json
+import time
+import heapq
+import threading
+from datetime import datetime
+
+from .hgbcore import atomic_write
+
+# interval in seconds at which disconnected targets with due jobs are probed
+CONNECTION_POLL_INTERVAL = 10
+# retry delays in seconds after failed jobs: BACKOFF_BASE, 2 * BACKOFF_BASE, ... up to BACKOFF_MAX
+BACKOFF_BASE = 15 * 60
+BACKOFF_MAX = 24 * 60 * 60
+
+# job kinds: periodicity key, key of the last execution, core function
+KINDS = {
+    "backup": ("per_backup", "last_backup", "run_backup"),
+    "check": ("per_check", "last_check", "verify_backup"),
+}
+
+
+class HGBScheduler:
+    # runs backups and verifications of connected targets when they are due according to
+    # per_backup and per_check (in days), using a priority queue of due times that is only
+    # recomputed when a job finishes or the configuration changes; failed jobs are retried with
+    # an exponential backoff, which is persisted along with the due times
+
+    def __init__(self, hgbcore, jobs, max_jobs=1, schedule_file=None):
+        self.hgbcore = hgbcore
+        self.jobs = jobs
+        self.max_jobs = max_jobs
+        if schedule_file is None:
+            schedule_file = os.path.splitext(hgbcore.config_file)[0] + ".schedule"
+        self.schedule_file = schedule_file
+        self.heap = []  # (due, target name, kind), may contain outdated entries
+        self.due = {}  # (target name, kind) -> due time
+        self.failures = {}  # (target name, kind) -> number of consecutive failures
+        self.retry = {}  # (target name, kind) -> earliest time of the next attempt after failures
+        self.running = {}  # job ID -> (target name, kind, last execution before the job)
+        self.cond = threading.Condition()
+        self.stopped = False
+        self.thread = None
+        self.load()
+        self.reschedule()
+        self.jobs.subscribe(self.job_event)
+
+    def load(self):
+        if not os.path.isfile(self.schedule_file):
+            return
+        with open(self.schedule_file) as f:
+            data = json.load(f)
+        for key, entry in data.items():
+            name, kind = key.rsplit(":", 1)
+            if entry["failures"]:
+                self.failures[(name, kind)] = entry["failures"]
+                self.retry[(name, kind)] = entry["retry"]
+
+    def save(self):
+        data = {
+            "{}:{}".format(name, kind): {
+                "due": due,
+                "failures": self.failures.get((name, kind), 0),
+                "retry": self.retry.get((name, kind)),
+            }
+            for (name, kind), due in self.due.items()
+        }
+        with atomic_write(self.schedule_file) as f:
+            json.dump(data, f, indent=4)
+
+    def compute_due(self, name, kind):
+        target = self.hgbcore.config["targets"][name]
+        per_key, last_key, fn = KINDS[kind]
+        if target.get(per_key) is None:
+            return None
+        if target[last_key] is None:
+            due = time.time()
+        else:
+            last = datetime.strptime(target[last_key], "%Y-%m-%d_%H:%M:%S")
+            due = last.timestamp() + target[per_key] * 24 * 60 * 60
+        return max(due, self.retry.get((name, kind), 0))
+
+    def push(self, name, kind):
+        due = self.compute_due(name, kind)
+        if due is None:
+            self.due.pop((name, kind), None)
+            return
+        self.due[(name, kind)] = due
+        heapq.heappush(self.heap, (due, name, kind))
+
+    def reschedule(self):
+        # recompute all due times (e.g. after the configuration was reloaded)
+        with self.cond:
+            self.heap = []
+            self.due = {}
+            for name in self.hgbcore.config["targets"]:
+                for kind in KINDS:
+                    self.push(name, kind)
+            self.save()
+            self.cond.notify()
+
+    def notify(self):
+        # wake up the scheduler, e.g. when a target got connected
+        with self.cond:
+            self.cond.notify()
+
+    def busy(self, name):
+        return any(job.name == name for job in self.jobs.active_jobs())
+
+    def start_job(self, name, kind):
+        target = self.hgbcore.config["targets"][name]
+        per_key, last_key, fn = KINDS[kind]
+        # read before submitting, a fast job may already have updated it
+        last = target[last_key]
+        job = self.jobs.submit(name, getattr(self.hgbcore, fn), target)
+        self.running[job.id] = (name, kind, last)
+
+    def job_event(self, job, event, *args):
+        # any finished job may unblock a due job (also jobs that were not started by us)
+        if event != "finished":
+            return
+        with self.cond:
+            if job.id in self.running:
+                self.job_finished(job, *self.running.pop(job.id))
+            self.cond.notify()
+
+    def job_finished(self, job, name, kind, last):
+        if name not in self.hgbcore.config["targets"]:
+            return
+        target = self.hgbcore.config["targets"][name]
+        # a job only succeeded if it reported so; a report left over from an earlier run does not
+        # count, hence the time of the last execution must have changed as well
+        ok = job.state == "done" and target.get("report", {}).get("ok", False)
+        if ok and target[KINDS[kind][1]] != last:
+            self.failures.pop((name, kind), None)
+            self.retry.pop((name, kind), None)
+        else:
+            failures = self.failures.get((name, kind), 0) + 1
+            self.failures[(name, kind)] = failures
+            backoff = min(BACKOFF_BASE * 2 ** (failures - 1), BACKOFF_MAX)
+            self.retry[(name, kind)] = time.time() + backoff
+            print(
+                "Scheduled {} of target {} failed, retrying in {:.0f} minutes.".format(
+                    kind, name, backoff / 60
+                )
+            )
+        self.push(name, kind)
+        self.save()
+
+    def run_due_jobs(self):
+        # starts the due jobs that can run; returns the time to wait until the next due job, or
+        # None if only disconnected or busy targets have due jobs
+        now = time.time()
+        blocked = []
+        waiting_for_connection = False
+        entries = []
+        while self.heap and self.heap[0][0] <= now:
+            due, name, kind = heapq.heappop(self.heap)
+            if self.due.get((name, kind)) != due or name not in self.hgbcore.config["targets"]:
+                continue  # outdated entry
+            entries.append((due, name, kind))
+        # probe the destinations of disconnected targets at once
+        disconnected = set(
+            name
+            for due, name, kind in entries
+            if not self.hgbcore.config["targets"][name]["dst_connected"]
+        )
+        if disconnected:
+            self.hgbcore.update_connections(disconnected)
+        for due, name, kind in entries:
+            target = self.hgbcore.config["targets"][name]
+            if not target["dst_connected"]:
+                waiting_for_connection = True
+                blocked.append((due, name, kind))
+            elif len(self.running) >= self.max_jobs or self.busy(name):
+                blocked.append((due, name, kind))
+            else:
+                self.start_job(name, kind)
+        for entry in blocked:
+            heapq.heappush(self.heap, entry)
+        if waiting_for_connection:
+            return CONNECTION_POLL_INTERVAL
+        future = [due for due, name, kind in self.heap if due > now]
+        return min(future) - now if future else None
+
+    def loop(self):
+        with self.cond:
+            while not self.stopped:
+                timeout = self.run_due_jobs()
+                self.cond.wait(timeout)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.loop, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        with self.cond:
+            self.stopped = True
+            self.cond.notify()
+        if self.thread is not None:
+            self.thread.join()
+        self.jobs.unsubscribe(self.job_event)
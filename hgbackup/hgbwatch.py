@@ -0,0 +1,194 @@
+import os
+import errno
+import select
+import struct
+import ctypes
+import ctypes.util
+import threading
+
+# c.f. /usr/include/linux/inotify.h
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = (
+    IN_MODIFY
+    | IN_ATTRIB
+    | IN_CLOSE_WRITE
+    | IN_MOVED_FROM
+    | IN_MOVED_TO
+    | IN_CREATE
+    | IN_DELETE
+    | IN_DELETE_SELF
+    | IN_ONLYDIR
+    | IN_DONT_FOLLOW
+)
+EVENT_HEADER = struct.Struct("iIII")
+# interval in seconds at which the reader thread checks whether it should stop
+POLL_INTERVAL = 0.5
+
+
+class Consumer:
+    def __init__(self, src):
+        self.src = src
+        self.dirty = set()  # paths relative to the parent of src, as expected by --files-from
+        self.ready = False  # all directories are watched
+        self.armed = False  # the dirty set covers all changes since the last backup
+        self.broken = False  # a directory could not be watched (e.g. inotify limit reached)
+        self.taking = False  # a backup is running, it may arm the consumer if it succeeds
+
+
+class HGBChangeTracker:
+    # records the paths that changed under the src of each tracked target between backups, using
+    # inotify, so that a backup can transfer only those with --files-from; the dirty set is only
+    # used if the tracker ran without interruption (i.e. without queue overflow and since before
+    # the previous backup started), otherwise a full scan is needed (take() returns None)
+
+    def __init__(self):
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.inotify_add_watch = libc.inotify_add_watch
+        self.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.watches = {}  # watch descriptor -> directory
+        self.consumers = {}  # target name -> Consumer
+        self.lock = threading.RLock()
+        self.stopped = False
+        self.thread = threading.Thread(target=self.loop, daemon=True)
+        self.thread.start()
+
+    def add_watches(self, top):
+        # watch top and all directories below it, returns the list of all paths found
+        paths = []
+        for dirpath, dirnames, filenames in os.walk(top):
+            with self.lock:
+                wd = self.inotify_add_watch(self.fd, os.fsencode(dirpath), WATCH_MASK)
+                if wd < 0:
+                    err = ctypes.get_errno()
+                    if err in [errno.ENOENT, errno.ENOTDIR]:
+                        continue  # removed in the meantime
+                    raise OSError(err, "inotify_add_watch failed: {}".format(dirpath))
+                self.watches[wd] = dirpath
+            paths.append(dirpath)
+            paths.extend(os.path.join(dirpath, f) for f in filenames)
+        return paths
+
+    def track(self, name, src):
+        consumer = Consumer(src)
+        with self.lock:
+            self.consumers[name] = consumer
+        try:
+            self.add_watches(src)
+            consumer.ready = True
+        except OSError as e:
+            print("Cannot track changes in {}: {}".format(src, e))
+            consumer.broken = True
+
+    def untrack(self, name):
+        with self.lock:
+            self.consumers.pop(name, None)
+
+    def tracks(self, name):
+        return name in self.consumers
+
+    def take(self, name):
+        # called when a backup starts; returns the dirty set, or None if a full scan is needed
+        with self.lock:
+            consumer = self.consumers.get(name)
+            if consumer is None:
+                return None
+            dirty = consumer.dirty if consumer.armed else None
+            consumer.dirty = set()
+            consumer.taking = consumer.ready and not consumer.broken
+            return dirty
+
+    def done(self, name, ok, taken):
+        # called when a backup finished; a successful backup arms the consumer, after a failed one
+        # the paths are merged back
+        with self.lock:
+            consumer = self.consumers.get(name)
+            if consumer is None:
+                return
+            if ok and consumer.taking:
+                consumer.armed = True
+            elif taken is not None:
+                consumer.dirty |= taken
+            consumer.taking = False
+
+    def mark(self, path):
+        for consumer in self.consumers.values():
+            if path == consumer.src or path.startswith(consumer.src + os.sep):
+                consumer.dirty.add(os.path.relpath(path, os.path.dirname(consumer.src)))
+
+    def overflow(self):
+        # events were lost, all consumers need a full scan
+        for consumer in self.consumers.values():
+            consumer.armed = False
+            consumer.taking = False
+
+    def handle_event(self, wd, mask, name):
+        if mask & IN_Q_OVERFLOW:
+            self.overflow()
+            return
+        directory = self.watches.get(wd)
+        if directory is None:
+            return
+        if mask & IN_IGNORED:
+            del self.watches[wd]
+            return
+        if mask & IN_DELETE_SELF:
+            return  # the deletion is also reported for the parent directory
+        path = os.path.join(directory, name) if name else directory
+        self.mark(path)
+        if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+            self.add_directory(path)
+
+    def add_directory(self, path):
+        # a directory was created or moved in; files may have been created before the watch was
+        # added, hence all paths found are marked
+        try:
+            for p in self.add_watches(path):
+                self.mark(p)
+        except OSError:
+            for consumer in self.consumers.values():
+                if path.startswith(consumer.src + os.sep):
+                    consumer.broken = True
+                    consumer.armed = False
+
+    def read_events(self):
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return
+        offset = 0
+        with self.lock:
+            while offset < len(data):
+                wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+                offset += EVENT_HEADER.size
+                name = os.fsdecode(data[offset : offset + length].rstrip(b"\0"))
+                offset += length
+                self.handle_event(wd, mask, name)
+
+    def loop(self):
+        while not self.stopped:
+            readable, _, _ = select.select([self.fd], [], [], POLL_INTERVAL)
+            if readable:
+                self.read_events()
+
+    def stop(self):
+        self.stopped = True
+        self.thread.join()
+        os.close(self.fd)
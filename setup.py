@@ -13,8 +13,6 @@ setuptools.setup(
     long_description_content_type="text/markdown",
     url="https://github.com/HolgerGraef/hgbackup",
     packages=setuptools.find_packages(),
-    package_data={"": ["pie/*.png"]},
-    include_package_data=True,
     classifiers=[
         "Programming Language :: Python :: 3.8",
         "Programming Language :: Python :: 3.9",
@@ -1,7 +1,18 @@
 import os
+import gzip
+import json
+import time
+import threading
 import pytest
 
+import hgbackup.hgbcore
+import hgbackup.hgbwatch
 from hgbackup.hgbcore import HGBCore
+from hgbackup.hgbjobs import HGBJobs
+from hgbackup.hgbsched import HGBScheduler
+from hgbackup.hgbwatch import HGBChangeTracker
+from hgbackup.hgbicon import HGBIcons, render_pie
+from hgbackup.hgbcli import HGBCLI, EXIT_FAILED, EXIT_UNAVAILABLE, EXIT_USAGE
 
 CFG = "/tmp/.hgbackup.json"
 SRC = "/tmp/hgb_test"
@@ -41,3 +52,567 @@ def test_backup(reload: bool):
     # run backup and verification
     hgbcore.run_backup(hgbcore.config["targets"]["test"])
     assert hgbcore.verify_backup(hgbcore.config["targets"]["test"]) == True
+
+
+def setup_environment():
+    # make sure we start with a clean environment
+    for path in [SRC, DST]:
+        if os.path.exists(path):
+            assert os.system(f"rm -rf {path}") == 0
+        os.makedirs(path)
+    for path in [CFG, CFG.replace(".json", ".digests")]:
+        if os.path.exists(path):
+            os.remove(path)
+
+    for name in ["file1", "file2", "file3"]:
+        create_random_file(f"{SRC}/{name}")
+
+    hgbcore = HGBCore(CFG)
+    hgbcore.add_target("test", SRC, DST)
+    return hgbcore
+
+
+def test_cli_batch(capsys):
+    hgbcore = setup_environment()
+    # copy the source by hand, so that the verification dictionary lacks all checksums
+    assert os.system(f"cp -r {SRC} {DST}/") == 0
+
+    hgbcli = HGBCLI(hgbcore)
+    argv = ["hgbackup", "check,repair,check", "te*", "--format", "ndjson"]
+    assert hgbcli.parse_command_line(argv) == EXIT_FAILED
+    results = [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+    assert [r["action"] for r in results] == ["check"]
+    assert results[0]["counts"]["missing_checksums"] == 3
+
+    argv = ["hgbackup", "check,repair,check", "--all", "--keep-going", "--format", "json"]
+    assert hgbcli.parse_command_line(argv) == EXIT_FAILED
+    results = json.loads(capsys.readouterr().out)["results"]
+    assert [r["ok"] for r in results] == [False, True, True]
+
+    assert hgbcli.parse_command_line(["hgbackup", "verify", "test", "missing"]) == EXIT_UNAVAILABLE
+
+
+def test_verify_fail_fast():
+    hgbcore = setup_environment()
+    target = hgbcore.config["targets"]["test"]
+    assert os.system(f"cp -r {SRC} {DST}/") == 0
+    hgbcore.check_verdict(target, repair=True)
+
+    # corrupt two files in the backup
+    name = os.path.basename(SRC)
+    create_random_file(f"{DST}/{name}/file1")
+    create_random_file(f"{DST}/{name}/file3")
+
+    assert hgbcore.verify_backup(target, max_errors=1) == False
+    report = target["report"]
+    assert report["aborted"] and len(report["bad"]) == 1
+    assert target["last_check"] is None
+
+    assert hgbcore.verify_backup(target) == False
+    assert sorted(b["path"] for b in target["report"]["bad"]) == [f"{name}/file1", f"{name}/file3"]
+    assert target["last_check"] is not None
+
+
+def test_sample_verify(monkeypatch):
+    hgbcore = setup_environment()
+    target = hgbcore.config["targets"]["test"]
+    for i in range(20):
+        create_random_file(f"{SRC}/small{i}", 100)
+    create_random_file(f"{SRC}/large", 1024 * 1024)
+    assert os.system(f"cp -r {SRC} {DST}/") == 0
+    hgbcore.check_verdict(target, repair=True)
+
+    assert hgbcore.sample_verify(target, sample_size=5, seed=0) == True
+    report = target["report"]
+    assert report["population"] == 24 and report["strata"] == 3
+    # every stratum is represented, including the single large file
+    assert report["sampled"] >= 3
+    assert report["estimated_rate"] == 0 and report["rate_upper"] > 0
+
+    # only the sizes of an oversample are looked up
+    stratified = []
+    stratify_keys = hgbcore.stratify_keys
+    monkeypatch.setattr(
+        hgbcore,
+        "stratify_keys",
+        lambda dst, keys, *args: stratified.append(len(keys)) or stratify_keys(dst, keys, *args),
+    )
+    monkeypatch.setattr(hgbackup.hgbcore, "SAMPLE_OVERSAMPLING", 2)
+    assert hgbcore.sample_verify(target, sample_size=5, seed=0) == True
+    assert stratified == [10] and target["report"]["population"] == 24
+    monkeypatch.undo()
+
+    # files too large for the byte budget are skipped, but a sample of nothing is not ok
+    assert hgbcore.sample_verify(target, sample_size=24, byte_budget=1000, seed=0) == True
+    report = target["report"]
+    assert report["budget_exhausted"] and report["sampled"] > 0 and report["bytes"] <= 1000
+    assert hgbcore.sample_verify(target, sample_size=24, byte_budget=10, seed=0) == False
+    assert target["report"]["sampled"] == 0 and not target["report"]["bad"]
+
+    # corrupt every file in the backup, but only allow reading a few bytes
+    name = os.path.basename(SRC)
+    for f in os.listdir(f"{DST}/{name}"):
+        create_random_file(f"{DST}/{name}/{f}", 100)
+    assert hgbcore.sample_verify(target, sample_size=24, byte_budget=1024, seed=0) == False
+    report = target["report"]
+    assert report["budget_exhausted"] and report["bytes"] <= 1024
+    assert report["estimated_rate"] == 1.0
+
+
+def test_verify_chunks():
+    hgbcore = setup_environment()
+    hgbcore.chunk_threshold = 1024
+    hgbcore.chunk_size = 256
+    target = hgbcore.config["targets"]["test"]
+    create_random_file(f"{SRC}/large", 2000)
+    assert os.system(f"cp -r {SRC} {DST}/") == 0
+    hgbcore.check_verdict(target, repair=True)
+
+    # the first verification records the chunk digests
+    assert hgbcore.verify_backup(target) == True
+    assert os.path.isfile(target["chunkfile"])
+
+    # flip a byte in the third chunk
+    name = os.path.basename(SRC)
+    with open(f"{DST}/{name}/large", "r+b") as f:
+        f.seek(600)
+        byte = f.read(1)
+        f.seek(600)
+        f.write(bytes([byte[0] ^ 0xFF]))
+
+    hgbcore = HGBCore(CFG)
+    hgbcore.chunk_threshold = 1024
+    target = hgbcore.config["targets"]["test"]
+    assert hgbcore.verify_backup(target, max_errors=1) == False
+    assert target["report"]["bad"][0]["path"] == f"{name}/large"
+    assert target["report"]["bad"][0]["ranges"] == [(512, 768)]
+
+
+def test_digest_cache(monkeypatch):
+    hgbcore = setup_environment()
+    target = hgbcore.config["targets"]["test"]
+    os.link(f"{SRC}/file1", f"{SRC}/file4")
+    assert os.system(f"cp -r --preserve=links {SRC} {DST}/") == 0
+
+    calls = []
+    md5sum = hgbackup.hgbcore.md5sum
+    monkeypatch.setattr(hgbackup.hgbcore, "md5sum", lambda path: calls.append(path) or md5sum(path))
+
+    # the source files are hashed once per inode, and the digests are kept for later runs
+    hgbcore.check_verdict(target, repair=True)
+    assert len(calls) == 3
+    target["verdict"].clear()
+    HGBCore(CFG).check_verdict(target, repair=True)
+    assert len(calls) == 3
+
+    # verifications do not rely on digests of previous runs
+    calls.clear()
+    assert hgbcore.verify_backup(target) == True
+    assert len(calls) == 3
+    # ... and only the digests of source files are kept
+    with open(CFG.replace(".json", ".digests")) as f:
+        assert len(f.readlines()) == 3
+
+
+def test_jobs():
+    hgbcore = setup_environment()
+    target = hgbcore.config["targets"]["test"]
+    assert os.system(f"cp -r {SRC} {DST}/") == 0
+    hgbcore.check_verdict(target, repair=True)
+
+    jobs = HGBJobs()
+    events = []
+    jobs.subscribe(lambda job, event, *args: events.append((job.name, event)))
+    try:
+        # concurrent jobs have separate output streams
+        job1 = jobs.submit("verify", hgbcore.verify_backup, target)
+        job2 = jobs.submit("sleep", hgbcore.run_process, ["sleep", "10"], print)
+        job3 = jobs.submit("check", hgbcore.check_verdict, target)
+        assert job1.wait(10) == True
+        job3.wait(10)
+        assert "The operation took" in job3.output
+        assert job1.output == "" and job2.output == ""
+        assert ("verify", "done_verify") in events
+
+        # cancelling terminates the process
+        job2.cancel()
+        assert job2.wait(10) != 0
+        assert job2.state == "cancelled"
+        assert ("sleep", "finished") in events
+
+        # the output of a process is handled in the thread of its job, not in the event loop
+        threads = []
+
+        def on_line(line):
+            threads.append(threading.current_thread())
+
+        job4 = jobs.submit("echo", hgbcore.run_process, ["echo", "a\nb"], on_line)
+        assert job4.wait(10) == 0
+        assert len(threads) == 2 and jobs.thread not in threads
+    finally:
+        jobs.shutdown()
+
+
+def test_verify_cancel_resume(monkeypatch):
+    hgbcore = setup_environment()
+    target = hgbcore.config["targets"]["test"]
+    assert os.system(f"cp -r {SRC} {DST}/") == 0
+    hgbcore.check_verdict(target, repair=True)
+
+    # cancel after the first file
+    check_file = hgbcore.check_file
+
+    def check_file_and_cancel(*args, **kwargs):
+        hgbcore.cancel_event.set()
+        return check_file(*args, **kwargs)
+
+    monkeypatch.setattr(hgbcore, "check_file", check_file_and_cancel)
+    assert hgbcore.verify_backup(target) == False
+    assert target["report"]["cancelled"] and target["report"]["checked"] == 1
+    assert os.path.isfile(hgbcore.verify_checkpoint_file(target))
+    assert target["last_check"] is None
+
+    monkeypatch.setattr(hgbcore, "check_file", check_file)
+    hgbcore.cancel_event.clear()
+    assert hgbcore.verify_backup(target, resume=True) == True
+    assert target["report"]["skipped"] == 1 and target["report"]["checked"] == 2
+    assert not os.path.isfile(hgbcore.verify_checkpoint_file(target))
+    assert target["last_check"] is not None
+
+
+def test_scheduler(monkeypatch):
+    hgbcore = setup_environment()
+    target = hgbcore.config["targets"]["test"]
+    assert os.system(f"cp -r {SRC} {DST}/") == 0
+    hgbcore.check_verdict(target, repair=True)
+    target["per_check"] = 1
+    schedule_file = CFG.replace(".json", ".schedule")
+    if os.path.exists(schedule_file):
+        os.remove(schedule_file)
+
+    jobs = HGBJobs()
+    scheduler = HGBScheduler(hgbcore, jobs)
+    finished = threading.Event()
+    # subscribed after the scheduler, so that it has processed the event when we get it
+    jobs.subscribe(lambda job, event, *args: event == "finished" and finished.set())
+    try:
+        # never verified, so the verification is due immediately
+        scheduler.start()
+        assert finished.wait(10)
+        assert target["last_check"] is not None
+        assert scheduler.due[("test", "check")] > time.time() + 23 * 60 * 60
+
+        # failures are retried later
+        def fail(target):
+            raise Exception("disk failure")
+
+        monkeypatch.setattr(hgbcore, "verify_backup", fail)
+        finished.clear()
+        target["last_check"] = None
+        scheduler.reschedule()
+        assert finished.wait(10)
+        assert scheduler.failures[("test", "check")] == 1
+        assert scheduler.due[("test", "check")] > time.time() + 10 * 60
+    finally:
+        scheduler.stop()
+        jobs.shutdown()
+
+    # the backoff survives a restart
+    scheduler = HGBScheduler(hgbcore, HGBJobs())
+    assert scheduler.failures[("test", "check")] == 1
+
+
+def test_change_tracker(monkeypatch):
+    hgbcore = setup_environment()
+    tracker = HGBChangeTracker()
+    try:
+        tracker.track("test", SRC)
+
+        def settle():
+            time.sleep(2 * hgbackup.hgbwatch.POLL_INTERVAL)
+
+        # the first backup after tracking started has to scan the whole source
+        assert tracker.take("test") is None
+        tracker.done("test", True, None)
+
+        create_random_file(f"{SRC}/file1")
+        os.mkdir(f"{SRC}/sub")
+        create_random_file(f"{SRC}/sub/file5")
+        os.remove(f"{SRC}/file2")
+        settle()
+        name = os.path.basename(SRC)
+        taken = tracker.take("test")
+        assert {f"{name}/file1", f"{name}/file2", f"{name}/sub", f"{name}/sub/file5"} <= taken
+        assert f"{name}/file3" not in taken
+
+        # changes are kept for the next backup if a backup fails
+        create_random_file(f"{SRC}/file3")
+        settle()
+        tracker.done("test", False, taken)
+        assert f"{name}/file1" in tracker.take("test")
+        tracker.done("test", True, None)
+
+        # ... also if it did not even complete
+        def fail(*args):
+            raise OSError("no space left on device")
+
+        hgbcore.tracker = tracker
+        monkeypatch.setattr(hgbcore, "rsync_backup", fail)
+        create_random_file(f"{SRC}/important")
+        settle()
+        with pytest.raises(OSError):
+            hgbcore.run_backup(hgbcore.config["targets"]["test"])
+        assert f"{name}/important" in tracker.take("test")
+        tracker.done("test", True, None)
+
+        # lost events require a full scan
+        with tracker.lock:
+            tracker.handle_event(-1, hgbackup.hgbwatch.IN_Q_OVERFLOW, "")
+        assert tracker.take("test") is None
+    finally:
+        tracker.stop()
+
+
+def test_logs(monkeypatch):
+    hgbcore = setup_environment()
+    target = hgbcore.config["targets"]["test"]
+    hgbcore.prepare_target(target)
+    monkeypatch.setattr(hgbackup.hgbcore, "LOG_KEEP", 3)
+
+    # logs are compressed and rotated
+    for i in range(5):
+        logfile, log = hgbcore.open_log(DST, "rsync_log", SRC, f"2024-01-0{i + 1}_00:00:00")
+        with log:
+            log.write("log {}\n".format(i))
+    logdir = os.path.dirname(logfile)
+    assert sorted(os.listdir(logdir)) == [
+        f"hgb_test_2024-01-0{i}_00:00:00.log.gz" for i in [3, 4, 5]
+    ]
+    assert gzip.open(logfile, "rt").read() == "log 4\n"
+
+    # the change index is merged with the changes of each backup
+    indexfile = hgbcore.change_index_file(target)
+    hgbackup.hgbcore.update_change_index(indexfile, "t1", ["hgb_test/b", "hgb_test/a"])
+    hgbackup.hgbcore.update_change_index(indexfile, "t2", ["hgb_test/c", "hgb_test/a"])
+    assert list(hgbcore.change_history(target, "hgb_test/*")) == [
+        ("hgb_test/a", ["t2", "t1"]),
+        ("hgb_test/b", ["t1"]),
+        ("hgb_test/c", ["t2"]),
+    ]
+
+
+def test_connection_probe(monkeypatch):
+    hgbcore = setup_environment()
+    os.makedirs(f"{SRC}2", exist_ok=True)
+    hgbcore.add_target("test2", f"{SRC}2", DST)
+
+    # targets sharing a destination are probed once, the ID file is read only once
+    opened = []
+    real_open = open
+    monkeypatch.setattr(
+        "builtins.open",
+        lambda path, *args, **kwargs: opened.append(path) or real_open(path, *args, **kwargs),
+    )
+    hgbcore = HGBCore(CFG)
+    hgbcore.update_connections()
+    monkeypatch.undo()
+    assert opened.count(f"{DST}/.hgbackup/id") == 1
+    assert all(t["dst_connected"] for t in hgbcore.config["targets"].values())
+
+    # a hung destination keeps its state after the timeout
+    release = threading.Event()
+    monkeypatch.setattr(
+        hgbackup.hgbcore, "probe_destination", lambda dst, cached: release.wait() and None
+    )
+    t0 = time.time()
+    connections = hgbcore.update_connections(timeout=0.1)
+    assert time.time() - t0 < 1
+    assert connections == {"test": (True, False), "test2": (True, False)}
+    release.set()
+    for probe in hgbcore.probes.values():
+        assert probe.done.wait(1)
+
+    # a target in use is not reset, even if its destination is gone
+    monkeypatch.setattr(hgbackup.hgbcore, "probe_destination", lambda dst, cached: None)
+    target = hgbcore.config["targets"]["test"]
+    with hgbcore.target_lock(target):
+        connections = threading.Thread(target=hgbcore.update_connections)
+        connections.start()
+        connections.join()
+        assert target["dst_connected"] and target["verfile"] is not None
+        assert not hgbcore.config["targets"]["test2"]["dst_connected"]
+    assert hgbcore.update_connections() == {"test": (False, True), "test2": (False, False)}
+
+
+def test_fanout():
+    hgbcore = setup_environment()
+    dst2 = f"{DST}2"
+    if os.path.exists(dst2):
+        assert os.system(f"rm -rf {dst2}") == 0
+    os.makedirs(dst2)
+    hgbcore.add_target("test2", SRC, dst2)
+    targets = [hgbcore.config["targets"][name] for name in ["test", "test2"]]
+
+    # the first fan-out scans both destinations, afterwards they are in sync
+    assert hgbcore.run_fanout(targets)
+    assert [t["report"]["fanout"] for t in targets] == ["primary", "full scan"]
+    assert hgbcore.load_sync_marker(targets[0]) == hgbcore.load_sync_marker(targets[1])
+
+    # only the changes are pushed to the second destination
+    time.sleep(1)  # the timestamps have a resolution of one second
+    create_random_file(f"{SRC}/file1")
+    os.remove(f"{SRC}/file2")
+    assert hgbcore.run_fanout(targets)
+    assert [t["report"]["fanout"] for t in targets] == ["primary", "change set"]
+    assert hgbcore.load_sync_marker(targets[0]) == hgbcore.load_sync_marker(targets[1])
+    assert not os.path.exists(f"{dst2}/hgb_test/file2")
+    for target in targets:
+        assert hgbcore.verify_backup(target)
+
+    # a destination whose last push failed is scanned again
+    time.sleep(1)
+    create_random_file(f"{SRC}/file3")
+    hgbcore.save_sync_marker(targets[1], None)
+    assert hgbcore.run_fanout(targets)
+    assert [t["report"]["fanout"] for t in targets] == ["primary", "full scan"]
+    assert hgbcore.load_sync_marker(targets[0]) == hgbcore.load_sync_marker(targets[1])
+    assert hgbcore.verify_backup(targets[1])
+
+
+def test_compare_targets():
+    hgbcore = setup_environment()
+    dst2 = f"{DST}2"
+    if os.path.exists(dst2):
+        assert os.system(f"rm -rf {dst2}") == 0
+    os.makedirs(dst2)
+    hgbcore.add_target("test2", SRC, dst2)
+    targets = [hgbcore.config["targets"][name] for name in ["test", "test2"]]
+    for target, files in zip(targets, [["file1", "file2", "file3"], ["file3", "file1"]]):
+        assert os.system(f"mkdir -p {target['dst']}/hgb_test") == 0
+        hgbcore.prepare_target(target)
+        for f in files:
+            target["verdict"][f"hgb_test/{f}"] = hgbackup.hgbcore.md5sum(f"{SRC}/{f}")
+            assert os.system(f"cp {SRC}/{f} {target['dst']}/hgb_test/") == 0
+        hgbcore.save_verdict(target)
+    targets[1]["verdict"]["hgb_test/file3"] = "0" * 32
+    hgbcore.save_verdict(targets[1])
+
+    # verification files are written sorted, and merge-joined
+    with open(targets[1]["verfile"]) as f:
+        assert [line.split()[1] for line in f] == ["hgb_test/file1", "hgb_test/file3"]
+    report = hgbcore.compare_targets(targets)
+    assert not report["ok"]
+    assert report["differing"] == 1
+    assert report["missing"] == {"test": 0, "test2": 1}
+
+    # missing entries of files that exist on dst are synced
+    assert os.system(f"cp {SRC}/file2 {dst2}/hgb_test/") == 0
+    report = hgbcore.compare_targets(targets, sync=True)
+    assert report["synced"] == {"test": 0, "test2": 1}
+    report = hgbcore.compare_targets(targets)
+    assert report["missing"] == {"test": 0, "test2": 0}
+
+
+def test_restore():
+    hgbcore = setup_environment()
+    target = hgbcore.config["targets"]["test"]
+    restored = "/tmp/hgb_test_restore"
+    if os.path.exists(restored):
+        assert os.system(f"rm -rf {restored}") == 0
+    assert os.system(f"cp -r {SRC} {DST}/") == 0
+    hgbcore.check_verdict(target, repair=True)
+
+    # an earlier version of file1, replaced by a later backup
+    backupdir = f"{DST}/.hgbackup/rsync_backup/hgb_test"
+    os.makedirs(backupdir)
+    create_random_file(f"{backupdir}/file1.backup_2024-01-02_00:00:00")
+    # a corrupt file is not restored
+    create_random_file(f"{DST}/hgb_test/file2")
+
+    report = hgbcore.restore(target, "hgb_test", restored)
+    assert not report["ok"]
+    assert (report["verified"], report["invalid"]) == (2, 1)
+    assert sorted(os.listdir(f"{restored}/hgb_test")) == ["file1", "file3"]
+    with open(f"{SRC}/file1", "rb") as f1, open(f"{restored}/hgb_test/file1", "rb") as f2:
+        assert f1.read() == f2.read()
+
+    report = hgbcore.restore(target, "hgb_test/file1", restored, before="2024-01-01_00:00:00")
+    assert (report["restored"], report["unverified"]) == (1, 1)
+    with open(f"{backupdir}/file1.backup_2024-01-02_00:00:00", "rb") as f1:
+        with open(f"{restored}/hgb_test/file1", "rb") as f2:
+            assert f1.read() == f2.read()
+
+    # files that cannot be restored are reported, e.g. if their folder cannot be created
+    assert os.system(f"rm -rf {restored} && mkdir {restored} && touch {restored}/hgb_test") == 0
+    report = hgbcore.restore(target, "hgb_test", restored)
+    assert (report["restored"], report["errors"]) == (0, 3) and not report["ok"]
+
+    # timestamps are compared as strings, so they must have the format of the backups
+    argv = ["hgbackup", "restore", "test", "hgb_test", restored, "2024-01-01"]
+    assert HGBCLI(hgbcore).parse_command_line(argv) == EXIT_USAGE
+
+
+def test_icons(monkeypatch):
+    monkeypatch.setenv("XDG_RUNTIME_DIR", "/tmp")
+    icons = HGBIcons()
+    name = icons.pie(50)
+    assert icons.pie(50) == name
+    with open(os.path.join(icons.path, name + ".png"), "rb") as f:
+        data = f.read()
+    assert data.startswith(b"\x89PNG") and data == render_pie(50)
+    assert render_pie(0) != data
+    icons.cleanup()
+    assert not os.path.exists(icons.path)
+
+
+def test_concurrent_config():
+    core1 = setup_environment()
+    core2 = HGBCore(CFG)
+    target = core2.config["targets"]["test"]
+    core2.prepare_target(target)
+    verdict = target["verdict"]
+
+    # each process only saves the targets (and keys) it modified
+    os.makedirs(f"{SRC}2", exist_ok=True)
+    core1.add_target("test2", f"{SRC}2", DST)
+    target["last_backup"] = "2024-01-01_00:00:00"
+    core2.save_config(names=["test"], keys=["last_backup"])
+    core1.config["targets"]["test"]["per_backup"] = 7
+    core1.save_config(names=["test"], keys=["per_backup"])
+    with open(CFG) as f:
+        data = json.load(f)
+    assert sorted(data["targets"]) == ["test", "test2"]
+    assert data["targets"]["test"]["last_backup"] == "2024-01-01_00:00:00"
+    assert data["targets"]["test"]["per_backup"] == 7
+    assert not [f for f in os.listdir("/tmp") if f.startswith(".hgbackup.json.tmp")]
+
+    # the configuration is reloaded when it changed, keeping the runtime state
+    assert core2.reload_config()
+    assert not core2.reload_config()
+    assert core2.config["targets"]["test"] is target and target["verdict"] is verdict
+    assert target["per_backup"] == 7
+    assert core2.config["targets"]["test2"]["dst_connected"]
+
+    # dictionaries saved by another process are reloaded, instead of being overwritten
+    target1 = core1.config["targets"]["test"]
+    core1.prepare_target(target1)
+    target1["verdict"]["hgb_test/file1"] = "0" * 32
+    core1.save_verdict(target1)
+    assert core2.prepare_target(target)[2]["hgb_test/file1"] == "0" * 32
+
+    # an invalid configuration is not loaded, but retried until it is fixed
+    with open(CFG) as f:
+        valid = f.read()
+    with open(CFG, "w") as f:
+        f.write(valid[:-10])
+    assert not core2.reload_config() and not core2.reload_config()
+    with open(CFG, "w") as f:
+        f.write(valid.replace('"per_backup": 7', '"per_backup": 8'))
+    assert core2.reload_config()
+    assert target["per_backup"] == 8
+
+    # a target can only be modified by one process at a time
+    with core1.target_lock(core1.config["targets"]["test"]):
+        with pytest.raises(Exception, match="in use"):
+            core2.verify_backup(target)
+        core1.verify_backup(core1.config["targets"]["test"])